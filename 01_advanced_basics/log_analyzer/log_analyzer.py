@@ -7,26 +7,117 @@
 #                     '$request_time';
 
 import shutil
+import struct
+import sys
 import argparse
+import array
+import contextlib
+import csv
+import multiprocessing
 import json
 import logging
 import re
 import gzip
+import heapq
+import io
+import itertools
+import math
+import mmap
+import operator
 import os
-from os.path import isfile, join, exists
-from collections import namedtuple
-from statistics import median
+import queue
+import subprocess
+import threading
+import time
+from os.path import join, exists
+from collections import namedtuple, deque
+from functools import lru_cache
+from statistics import median, NormalDist
 from string import Template
-from datetime import datetime, MINYEAR
+from datetime import datetime, timedelta, timezone, MINYEAR
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# nginx log_format ui_short (see above), used to generate line parser
+LOG_FORMAT = ('$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
+              '$status $body_bytes_sent "$http_referer" '
+              '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
+              '$request_time')
+
+# Early check of error threshold while parsing (see ErrorThresholdCheck): number of lines read before
+# the first check and confidence of decision that share of bad lines is above threshold
+ERROR_CHECK_MIN_LINES = 10000
+ERROR_CHECK_CONFIDENCE = 0.999
 
 config = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR": "./reports",
     "LOG_DIR": "./log",
     "LOGGER_FILENAME": None,
-    "TEMPLATE_DIR": "./template"
+    "TEMPLATE_DIR": "./template",
+    "WORKERS": 1,
+    "AGGREGATION": "exact",
+    "LOG_FORMAT": LOG_FORMAT,
+    "INCREMENTAL": False,
+    "FOLLOW_FILENAME": "nginx-access-ui.log",
+    "FOLLOW_INTERVAL": 60,
+    "URL_STRIP_QUERY": False,
+    "URL_COLLAPSE_NUMBERS": False,
+    "URL_RULES": [],
+    "URL_MAX_COUNT": None,
+    "GZIP_READER": "thread",
+    "AGGREGATION_BACKEND": "python",
+    "LOG_INDEX": False,
+    "ERROR_CHECK_MIN_LINES": ERROR_CHECK_MIN_LINES,
+    "ERROR_CHECK_CONFIDENCE": ERROR_CHECK_CONFIDENCE,
+    "REPORT_FORMATS": ["html"],
+    "SERIES_BUCKET": None
 }
 
+# Minimal size of byte-range chunk for parallel parsing of plain logs
+CHUNK_MIN_SIZE = 1 << 20
+# Size of decompressed block dispatched to worker for parallel parsing of gz logs
+GZ_BLOCK_SIZE = 1 << 22
+# Size and number of reusable buffers of LogReader. Buffers grow from READ_FIRST_BUFFER_SIZE
+# to READ_BUFFER_SIZE while file is read, so small files are not read into large buffers
+READ_FIRST_BUFFER_SIZE = 1 << 16
+READ_BUFFER_SIZE = 1 << 20
+READ_BUFFERS_COUNT = 4
+# Ways to decompress gz logs (see LogReader)
+GZIP_READERS = ('builtin', 'thread', 'external')
+# Backends of exact aggregation: per-url lists of times or numpy arrays (see aggregate_columnar)
+AGGREGATION_BACKENDS = ('python', 'numpy')
+# Number of (url, request_time) pairs collected into arrays at once by numpy backend
+COLUMNAR_BATCH_SIZE = 1 << 16
+# Early error threshold check is done every ERROR_CHECK_BAD_LINES bad lines, so good lines cost nothing
+ERROR_CHECK_BAD_LINES = 256
+# External decompressors in order of preference
+GZIP_TOOLS = (['pigz', '-dc'], ['zcat'])
+# Relative error of quantiles estimated by HistogramStat
+HISTOGRAM_ACCURACY = 0.01
+# Quantiles added to report as time_pNN columns
+REPORT_PERCENTILES = (90, 95, 99)
+# Subfolder of REPORT_DIR with per-url aggregate states of analysed files
+STATE_DIR_NAME = 'state'
+# Compression level of stored states. Level 9 is slower and hardly makes binary request times smaller
+STATE_COMPRESS_LEVEL = 6
+# Periods of rollup reports built from stored states
+ROLLUP_PERIODS = ('week', 'month')
+# Key of aggregate for urls above URL_MAX_COUNT distinct ones
+OTHER_URL = '(other)'
+# Number of raw urls which normalized values are cached. Caches of decoded urls are cleared when they
+# exceed this size, so parsed urls are deduplicated in bounded memory
+URL_CACHE_SIZE = 1 << 16
+# Number of minutes of $time_local which timestamps are cached
+TIME_CACHE_SIZE = 1 << 12
+# Key of series of all requests
+SERIES_ALL = '(all)'
+# Seconds between checks of followed log file for new lines
+FOLLOW_POLL_INTERVAL = 1.0
+
 
 def setup_logger(logger_filename: str):
     """Setting up logger"""
@@ -42,12 +133,27 @@ def setup_logger(logger_filename: str):
                         datefmt='%Y.%m.%d %H:%M:%S')
 
 
-def get_config_filename():
-    """Parses command line and returns config file name"""
+def get_command_line_args():
+    """Parses command line and returns arguments namespace"""
     parser = argparse.ArgumentParser(description="Log analyzer OTUS Phyton hometask")
     parser.add_argument('--config', default="./log_analyzer.cfg",
                         help='configuration file in JSON format (default is ./log_analyzer.cfg)')
-    return parser.parse_args().config
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes to parse log file (overrides WORKERS from config)')
+    parser.add_argument('--rollup', choices=ROLLUP_PERIODS, default=None,
+                        help='build report for week or month of latest stored state (see INCREMENTAL) '
+                             'instead of analysing log file')
+    parser.add_argument('--follow', action='store_true',
+                        help='follow current log file (FOLLOW_FILENAME) and regenerate report-live.html '
+                             'every FOLLOW_INTERVAL seconds')
+    parser.add_argument('--backfill', action='store_true',
+                        help='report every log file without report in LOG_DIR using WORKERS processes')
+    return parser.parse_args()
+
+
+def get_config_filename():
+    """Parses command line and returns config file name"""
+    return get_command_line_args().config
 
 
 def reload_config(config_filename, default_cfg):
@@ -60,113 +166,1549 @@ def reload_config(config_filename, default_cfg):
     return result_cfg
 
 
-def get_latest_logfile_info(folder_path) -> namedtuple('FileDescription', 'path date'):
-    """Looks for latest nginx-access-ui.. log file in the folder_path"""
-    FileDescription = namedtuple('FileDescription', 'path date')
-    ret_val = FileDescription(None, datetime(MINYEAR, 1, 1))
-    regexp_filename = re.compile('(nginx-access-ui.log-\d{8}\.gz)|(nginx-access-ui.log-\d{8})')
-    for file_name in os.listdir(folder_path):
-        full_path_name = join(folder_path, file_name)
-        if isfile(full_path_name) and regexp_filename.fullmatch(file_name):
-            file_date_str = re.search('\d{8}', file_name).group()
+def apply_command_line_args(cfg, args):
+    """Returns config updated with parameters given in command line"""
+    result_cfg = dict(cfg)
+    if args.workers is not None:
+        result_cfg['WORKERS'] = args.workers
+    return result_cfg
+
+
+# Name of nginx log file with date groups
+LOG_FILENAME_PATTERN = re.compile(r'nginx-access-ui\.log-(\d{4})(\d{2})(\d{2})(?:\.gz)?')
+# Name of persistent index of log folder files in REPORT_DIR/STATE_DIR_NAME
+LOG_INDEX_NAME = 'log-index.json'
+# Folder modified less than this number of seconds before scan could be modified again unnoticed
+# (mtime granularity of some file systems), so its content is not trusted by the index
+DIR_MTIME_GRANULARITY = 2
+
+FileDescription = namedtuple('FileDescription', 'path date')
+
+
+def iter_log_dir(folder_path):
+    """Yields (dir_entry, date) of nginx log files in the folder_path in one pass over os.scandir.
+    Date is extracted from file name groups, names with invalid dates are skipped"""
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            match = LOG_FILENAME_PATTERN.fullmatch(entry.name)
+            if not match or not entry.is_file():
+                continue
             try:
-                file_date = datetime.strptime(file_date_str, '%Y%m%d')
+                yield entry, datetime(*map(int, match.groups()))
             except ValueError:
                 continue
-            if file_date > ret_val.date:
-                ret_val = FileDescription(full_path_name, file_date)
+
+
+class LogIndex:
+    """Persistent index of nginx log files of a folder: file name -> [date 'YYYYMMDD', size, mtime_ns, reported].
+    Folder is rescanned only when its mtime changes, known entries are kept without stat and date parsing"""
+
+    def __init__(self, index_filename, log_dir):
+        self.index_filename = index_filename
+        self.log_dir = log_dir
+        self.dir_mtime = None
+        self.files = {}
+        self.modified = False
+
+    @classmethod
+    def load(cls, index_filename, log_dir):
+        """Reads index from index_filename. Returns empty index if file is absent, broken or belongs to other folder"""
+        index = cls(index_filename, log_dir)
+        try:
+            with open(index_filename, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return index
+        if data.get('log_dir') == os.path.abspath(log_dir):
+            index.dir_mtime = data['dir_mtime']
+            index.files = data['files']
+        return index
+
+    def save(self):
+        """Writes index atomically if it was modified"""
+        if not self.modified:
+            return
+        os.makedirs(os.path.dirname(self.index_filename), exist_ok=True)
+        tmp_filename = self.index_filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            json.dump({'log_dir': os.path.abspath(self.log_dir), 'dir_mtime': self.dir_mtime, 'files': self.files},
+                      f, separators=(',', ':'))
+        os.replace(tmp_filename, self.index_filename)
+        self.modified = False
+
+    def update(self):
+        """Rescans folder if it was modified since previous scan"""
+        st = os.stat(self.log_dir)
+        if self.dir_mtime is not None and st.st_mtime_ns == self.dir_mtime:
+            return
+        files = {}
+        for entry, date in iter_log_dir(self.log_dir):
+            if entry.name in self.files:
+                files[entry.name] = self.files[entry.name]
+            else:
+                st_file = entry.stat()
+                files[entry.name] = [date.strftime('%Y%m%d'), st_file.st_size, st_file.st_mtime_ns, False]
+        self.files = files
+        trusted = time.time() - st.st_mtime_ns / 1e9 > DIR_MTIME_GRANULARITY
+        self.dir_mtime = st.st_mtime_ns if trusted else None
+        self.modified = True
+
+    def latest(self):
+        """Returns FileDescription of the latest log file in index"""
+        if not self.files:
+            return FileDescription(None, datetime(MINYEAR, 1, 1))
+        file_name = max(self.files, key=lambda name: self.files[name][0])
+        return FileDescription(join(self.log_dir, file_name), datetime.strptime(self.files[file_name][0], '%Y%m%d'))
+
+    def is_changed(self, path):
+        """Returns True if log file size or mtime differ from indexed ones, so its report is outdated"""
+        st = os.stat(path)
+        _, size, mtime, _ = self.files[os.path.basename(path)]
+        return (size, mtime) != (st.st_size, st.st_mtime_ns)
+
+    def is_reported(self, path):
+        """Returns True if report of unchanged log file was generated"""
+        return self.files[os.path.basename(path)][3] and not self.is_changed(path)
+
+    def set_reported(self, path):
+        """Marks log file as reported storing its current size and mtime"""
+        st = os.stat(path)
+        self.files[os.path.basename(path)][1:] = [st.st_size, st.st_mtime_ns, True]
+        self.modified = True
+
+
+def get_log_index_filename(report_dir):
+    """Returns name of persistent index of log folder"""
+    return join(report_dir, STATE_DIR_NAME, LOG_INDEX_NAME)
+
+
+def get_latest_logfile_info(folder_path, index=None) -> FileDescription:
+    """Looks for latest nginx-access-ui.. log file in the folder_path (or in the updated LogIndex of it)"""
+    if index is not None:
+        index.update()
+        return index.latest()
+    ret_val = FileDescription(None, datetime(MINYEAR, 1, 1))
+    for entry, date in iter_log_dir(folder_path):
+        if date > ret_val.date:
+            ret_val = FileDescription(join(folder_path, entry.name), date)
     return ret_val
 
 
-def parse_next_line(logfile_name, error_threshold):
-    """Generator, returns (url,request_time) for next line. Raises WrongFileToParseException on error threshold"""
+HTTP_METHODS = ('GET', 'POST', 'HEAD', 'PUT', 'OPTIONS', 'CONNECT', 'TRACE', 'PATCH', 'DELETE')
+
+# Groups and patterns of log_format variables which values are used in analysis.
+# Other variables match any text up to the next literal character of format
+LOG_VARIABLE_PATTERNS = {
+    'request': ('url', b'(?:' + b'|'.join(m.encode() for m in HTTP_METHODS) + rb') (?P<url>[^ "]+) HTTP/\d\.\d'),
+    'request_uri': ('url', rb'(?P<url>[^ "]+)'),
+    'request_time': ('request_time', rb'(?P<request_time>\d+\.\d+)'),
+}
+# Group and pattern of $time_local, which is captured only for time series
+TIME_LOCAL_PATTERN = ('time_local', rb'(?P<time_local>\d{2}/[A-Za-z]{3}/\d{4}:\d{2}:\d{2}:\d{2} [+-]\d{4})')
+
+
+@lru_cache(maxsize=None)
+def compile_log_format(log_format, time_local=False):
+    """Returns compiled bytes regex matching the whole line of nginx log_format.
+    Regex has groups 'url' and 'request_time' (and 'time_local' if time_local is True).
+    Raises ValueError if format lacks them"""
+    variable_patterns = dict(LOG_VARIABLE_PATTERNS, time_local=TIME_LOCAL_PATTERN) if time_local \
+        else LOG_VARIABLE_PATTERNS
+    tokens = re.split(r'\$(\w+)', log_format)
+    pattern = []
+    groups = set()
+    for i, token in enumerate(tokens):
+        if i % 2 == 0:
+            for part in re.split(r'(\s+)', token):
+                pattern.append(b' +' if part.isspace() else re.escape(part.encode()))
+        elif token in variable_patterns and variable_patterns[token][0] not in groups:
+            group, var_pattern = variable_patterns[token]
+            pattern.append(var_pattern)
+            groups.add(group)
+        else:
+            stop_char = tokens[i + 1][:1]
+            if not stop_char or stop_char.isspace():
+                pattern.append(rb'\S*')
+            else:
+                pattern.append(b'[^' + re.escape(stop_char.encode()) + b']*')
+    pattern.append(rb'\s*\Z')
+    regexp = re.compile(b''.join(pattern))
+    if 'url' not in regexp.groupindex or 'request_time' not in regexp.groupindex:
+        raise ValueError('Log format should contain $request (or $request_uri) and $request_time: ' + log_format)
+    if time_local and 'time_local' not in regexp.groupindex:
+        raise ValueError('Log format should contain $time_local to build time series: ' + log_format)
+    return regexp
+
+
+MONTHS = {month.encode(): i for i, month in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+
+@lru_cache(maxsize=TIME_CACHE_SIZE)
+def _minute_timestamp(minute):
+    """Returns POSIX timestamp of minute of $time_local without seconds: b'29/Jun/2017:03:50 +0300'"""
+    local = datetime(int(minute[7:11]), MONTHS[minute[3:6]], int(minute[:2]), int(minute[12:14]), int(minute[15:17]),
+                     tzinfo=timezone.utc)
+    offset = int(minute[19:21]) * 3600 + int(minute[21:23]) * 60
+    return int(local.timestamp()) - (offset if minute[18:19] == b'+' else -offset)
+
+
+def parse_time_local(value):
+    """Returns POSIX timestamp (int) of $time_local value (bytes) like b'29/Jun/2017:03:50:22 +0300'.
+    Lines of log go in time order, so timestamps of minutes are taken from cache and only seconds are parsed"""
+    return _minute_timestamp(value[:17] + value[20:]) + int(value[18:20])
+
+
+def parse_line(s, regexp=None, urls=None):
+    """Returns (url, request_time) for line of log file (bytes) or None if line couldn't be parsed.
+    regexp is compiled log format (see compile_log_format), default is LOG_FORMAT.
+    urls is cache {url bytes: url} (see URL_CACHE_SIZE), so equal urls are decoded once and share one string"""
+    match = (regexp or compile_log_format(LOG_FORMAT)).match(s)
+    if not match:
+        return None
+    if urls is None:
+        try:
+            return match.group('url').decode(encoding='utf-8'), float(match.group('request_time'))
+        except UnicodeDecodeError:
+            return None
+    url = urls.get(match['url'])
+    if url is None:
+        url = decode_url(match['url'], urls)
+        if url is None:
+            return None
+    return url, float(match['request_time'])
+
+
+def decode_url(url_bytes, urls):
+    """Decodes url and puts it to cache {url bytes: url}. Returns None if url is not valid utf-8"""
+    try:
+        url = url_bytes.decode(encoding='utf-8')
+    except UnicodeDecodeError:
+        return None
+    if len(urls) >= URL_CACHE_SIZE:
+        urls.clear()
+    urls[url_bytes] = url
+    return url
+
+
+def parse_timed_line(s, regexp, urls):
+    """Returns (url, request_time, timestamp) for line of log file or None if line couldn't be parsed.
+    regexp is compiled log format with time_local group, urls is cache of decoded urls (see parse_line)"""
+    match = regexp.match(s)
+    if not match:
+        return None
+    url = urls.get(match['url']) or decode_url(match['url'], urls)
+    if url is None:
+        return None
+    try:
+        return url, float(match['request_time']), parse_time_local(match['time_local'])
+    except (KeyError, ValueError):
+        return None
+
+
+def check_error_threshold(good_parse, bad_parse, error_threshold):
+    """Raises UserWarning if percent of bad parsed lines is above error_threshold"""
+    failure_perc = 100 if good_parse + bad_parse == 0 else bad_parse * 100 // (good_parse + bad_parse)
+    if failure_perc > error_threshold:
+        raise UserWarning("File format error: "
+                          "{}% lines wasn't parsed successfully".format(failure_perc))
+
+
+class ErrorThresholdCheck:
+    """Early check of error threshold on the lines read so far. Raises UserWarning as soon as share of bad lines
+    is above error_threshold% with given confidence (lower bound of Wilson score interval is above threshold).
+    Lines are checked after min_lines lines are read, confidence None or 0 disables the check.
+    check_error_threshold compares floored percent, so file fails only at (error_threshold + 1)% of bad lines
+    and the same bound is used here: the early check never stops a file the final check accepts"""
+
+    def __init__(self, error_threshold, min_lines=ERROR_CHECK_MIN_LINES, confidence=ERROR_CHECK_CONFIDENCE):
+        self.threshold = (error_threshold + 1) / 100
+        self.min_lines = min_lines
+        self.z = NormalDist().inv_cdf(confidence) if confidence else None
+
+    def lower_bound(self, good_parse, bad_parse):
+        """Returns lower bound of bad lines share confidence interval"""
+        n = good_parse + bad_parse
+        p = bad_parse / n
+        z2 = self.z * self.z
+        return (p + z2 / (2 * n) - self.z * math.sqrt(p * (1 - p) / n + z2 / (4 * n * n))) / (1 + z2 / n)
+
+    def __call__(self, good_parse, bad_parse):
+        if self.z is None or good_parse + bad_parse < self.min_lines:
+            return
+        if self.lower_bound(good_parse, bad_parse) > self.threshold:
+            raise UserWarning("File format error: {} of first {} lines wasn't parsed successfully, "
+                              "parsing is stopped".format(bad_parse, good_parse + bad_parse))
+
+
+def get_error_check(cfg):
+    """Returns early error threshold check parameters of config as arguments for ErrorThresholdCheck"""
+    return cfg['ERROR_CHECK_MIN_LINES'], cfg['ERROR_CHECK_CONFIDENCE']
+
+
+def open_log_file(logfile_name):
+    """Opens plain or gz log file for binary reading"""
+    return gzip.open(logfile_name) if logfile_name.endswith('.gz') else open(logfile_name, "rb")
+
+
+def find_gzip_tool():
+    """Returns command line of external gz decompressor (pigz or zcat) or None if there is no one"""
+    for command in GZIP_TOOLS:
+        if shutil.which(command[0]):
+            return command
+    return None
+
+
+class LogReader:
+    """Reads plain or gz log file by large blocks into reusable buffers and splits them into lines in bulk.
+    gz file is decompressed depending on gzip_reader: 'builtin' - by gzip module in the same thread,
+    'thread' - by gzip module in background thread, 'external' - by pigz/zcat process
+    read in background thread ('thread' is used if there is no such tool)"""
+
+    def __init__(self, logfile_name, gzip_reader='thread', buffer_size=READ_BUFFER_SIZE):
+        if gzip_reader not in GZIP_READERS:
+            raise ValueError('Unknown gzip reader "{}". Use one of: {}'.format(gzip_reader, ', '.join(GZIP_READERS)))
+        self.logfile_name = logfile_name
+        self.gzip_reader = gzip_reader if logfile_name.endswith('.gz') else 'builtin'
+        self.buffer_size = buffer_size
+        self.process = None
+
+    def _open(self):
+        if self.gzip_reader == 'external':
+            command = find_gzip_tool()
+            if command:
+                self.process = subprocess.Popen(command + [self.logfile_name], stdout=subprocess.PIPE)
+                return self.process.stdout
+        return open_log_file(self.logfile_name)
+
+    def _close(self, f, finished):
+        """Closes file. If file was read to the end, checks external process exit code, else kills it"""
+        f.close()
+        if self.process:
+            if not finished:
+                self.process.kill()
+            returncode = self.process.wait()
+            self.process = None
+            if finished and returncode:
+                raise OSError('gz decompressor failed with code {} on {}'.format(returncode, self.logfile_name))
+
+    def _buffers(self):
+        """Generator, returns (buffer, size) of read data. Buffer is reused after the next item is requested"""
+        if self.gzip_reader == 'builtin':
+            f = self._open()
+            size = 0
+            try:
+                buf = bytearray(min(READ_FIRST_BUFFER_SIZE, self.buffer_size))
+                while True:
+                    size = f.readinto(buf)
+                    if not size:
+                        break
+                    yield buf, size
+                    if size == len(buf) < self.buffer_size:
+                        buf = bytearray(min(len(buf) * 2, self.buffer_size))
+            finally:
+                self._close(f, not size)
+            return
+
+        free_buffers = queue.Queue()
+        full_buffers = queue.Queue()
+        stopped = threading.Event()
+
+        def read():
+            try:
+                f = self._open()
+                size = 1
+                allocated = 0
+                buffer_size = min(READ_FIRST_BUFFER_SIZE, self.buffer_size)
+                try:
+                    while size and not stopped.is_set():
+                        if allocated < READ_BUFFERS_COUNT and free_buffers.empty():
+                            buf = bytearray(buffer_size)
+                            allocated += 1
+                        else:
+                            buf = free_buffers.get()
+                            if stopped.is_set():
+                                break
+                            if len(buf) < buffer_size:
+                                buf = bytearray(buffer_size)
+                        size = f.readinto(buf)
+                        if size:
+                            full_buffers.put((buf, size))
+                        if size == len(buf):
+                            buffer_size = min(buffer_size * 2, self.buffer_size)
+                finally:
+                    self._close(f, not stopped.is_set())
+                full_buffers.put((b'', 0))
+            except Exception as ex:
+                full_buffers.put((None, ex))
+
+        thread = threading.Thread(target=read, daemon=True)
+        thread.start()
+        try:
+            while True:
+                buf, size = full_buffers.get()
+                if buf is None:
+                    raise size
+                if not size:
+                    break
+                yield buf, size
+                free_buffers.put(buf)
+        finally:
+            stopped.set()
+            free_buffers.put(bytearray(0))
+            thread.join()
+
+    def __iter__(self):
+        """Generator, returns lines (without line end) of log file"""
+        rest = b''
+        for buf, size in self._buffers():
+            lines = (buf if size == len(buf) else buf[:size]).split(b'\n')
+            lines[0] = rest + lines[0]
+            rest = bytes(lines.pop())
+            yield from lines
+        if rest:
+            yield rest
+
+    def blocks(self):
+        """Generator, returns blocks of log file aligned to line ends"""
+        rest = b''
+        for buf, size in self._buffers():
+            end = buf.rfind(b'\n', 0, size)
+            if end < 0:
+                rest += buf[:size]
+                continue
+            yield rest + buf[:end + 1]
+            rest = bytes(buf[end + 1:size])
+        if rest:
+            yield rest
+
+
+def parse_mapped_file(logfile_name, regexp, start=0, end=None):
+    """Generator, returns (url, request_time) or None (line couldn't be parsed) for every line of plain log file
+    in byte range [start, end). File is memory-mapped and regexp is matched in place, so lines are not copied.
+    Url bytes are decoded once, when url is met for the first time (see decode_url)"""
+    with open(logfile_name, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm) if end is None else min(end, len(mm))
+            urls = {}
+            match = regexp.match
+            find = mm.find
+            pos = start
+            while pos < size:
+                line_end = find(b'\n', pos, size)
+                if line_end < 0:
+                    line_end = size
+                m = match(mm, pos, line_end)
+                pos = line_end + 1
+                if m is None:
+                    yield None
+                    continue
+                url = urls.get(m['url'])
+                if url is None:
+                    url = decode_url(m['url'], urls)
+                    if url is None:
+                        yield None
+                        continue
+                yield url, float(m['request_time'])
+
+
+def parse_next_line(logfile_name, error_threshold, log_format=LOG_FORMAT, gzip_reader='thread',
+                    error_check=(ERROR_CHECK_MIN_LINES, ERROR_CHECK_CONFIDENCE), with_time=False):
+    """Generator, returns (url,request_time) for next line. Raises WrongFileToParseException on error threshold.
+    Threshold is checked early by ErrorThresholdCheck with error_check arguments.
+    gz files are read by LogReader, plain ones are parsed in place by parse_mapped_file.
+    If with_time is True, returns (url, request_time, timestamp of $time_local) (see parse_timed_line)"""
     good_parse = 0
     bad_parse = 0
-    regexp_url = re.compile('((GET)|(POST)|(HEAD)|(PUT)|(OPTIONS)|(CONNECT)|(TRACE)|(PATCH)|(DELETE)) .+ HTTP/\d\.\d')
-    regexp_time = re.compile('" \d+\.\d{1,3}\s')
-    f = gzip.open(logfile_name) if logfile_name.endswith('.gz') else open(logfile_name, "rb")
-
-    for s in f:
-        line = s.decode(encoding='utf-8')
-        match_url = regexp_url.search(line)
-        if not match_url:
-            bad_parse += 1
-            continue
-        url = match_url.group().split(sep=' ')[1]
-        match_time = regexp_time.search(line, match_url.span()[1])
-        if not match_time:
+    regexp = compile_log_format(log_format, with_time)
+    check_early = ErrorThresholdCheck(error_threshold, *error_check)
+    if with_time:
+        urls = {}
+        parsed_lines = (parse_timed_line(s, regexp, urls) for s in LogReader(logfile_name, gzip_reader))
+    elif logfile_name.endswith('.gz'):
+        urls = {}
+        parsed_lines = (parse_line(s, regexp, urls) for s in LogReader(logfile_name, gzip_reader))
+    else:
+        parsed_lines = parse_mapped_file(logfile_name, regexp)
+
+    for parsed in parsed_lines:
+        if parsed is None:
             bad_parse += 1
+            if not bad_parse % ERROR_CHECK_BAD_LINES:
+                check_early(good_parse, bad_parse)
             continue
         good_parse += 1
-        time = float(match_time.group()[2:-1])
-        yield (url, time)
+        yield parsed
 
-    f.close()
     logging.debug('{} lines parsed from {}'.format(good_parse, good_parse + bad_parse))
+    check_error_threshold(good_parse, bad_parse, error_threshold)
 
-    failure_perc = 100 if good_parse + bad_parse == 0 else bad_parse * 100 // (good_parse + bad_parse)
-    if failure_perc > error_threshold:
-        raise UserWarning("File format error: "
-                          "{}% lines wasn't parsed successfully".format(failure_perc))
+
+class ExactStat:
+    """Per-url statistic keeping all request times in array of doubles (8 bytes per request).
+    Gives exact median and percentiles"""
+
+    __slots__ = ('times', )
+
+    def __init__(self):
+        self.times = array.array('d')
+
+    def add(self, time):
+        self.times.append(time)
+
+    def merge(self, other):
+        self.times.extend(other.times)
+
+    def to_state(self):
+        return self.times.tobytes()
+
+    @classmethod
+    def from_state(cls, state):
+        stat = cls()
+        stat.times.frombytes(state)
+        return stat
+
+    @property
+    def count(self):
+        return len(self.times)
+
+    @property
+    def time_sum(self):
+        return sum(self.times)
+
+    @property
+    def time_max(self):
+        return max(self.times)
+
+    def median(self):
+        return median(self.times)
+
+    def quantile(self, q):
+        """Returns q-quantile (0 <= q <= 1) with linear interpolation between closest ranks"""
+        ordered = sorted(self.times)
+        pos = q * (len(ordered) - 1)
+        low = int(pos)
+        high = min(low + 1, len(ordered) - 1)
+        return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+class HistogramStat:
+    """Per-url statistic in constant memory: count, sum, max and histogram with logarithmic buckets.
+    Bucket i holds times in (gamma^(i-1), gamma^i], so any quantile is estimated
+    with relative error not more than HISTOGRAM_ACCURACY"""
+
+    __slots__ = ('count', 'time_sum', 'time_max', 'zero_count', 'buckets')
+
+    gamma = (1 + HISTOGRAM_ACCURACY) / (1 - HISTOGRAM_ACCURACY)
+    log_gamma = math.log(gamma)
+
+    def __init__(self):
+        self.count = 0
+        self.time_sum = 0.0
+        self.time_max = 0.0
+        self.zero_count = 0
+        self.buckets = {}
+
+    def add(self, time):
+        self.count += 1
+        self.time_sum += time
+        if time > self.time_max:
+            self.time_max = time
+        if time <= 0:
+            self.zero_count += 1
+            return
+        index = math.ceil(math.log(time) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.time_sum += other.time_sum
+        self.time_max = max(self.time_max, other.time_max)
+        self.zero_count += other.zero_count
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def to_state(self):
+        return [self.count, self.time_sum, self.time_max, self.zero_count, list(self.buckets.items())]
+
+    @classmethod
+    def from_state(cls, state):
+        stat = cls()
+        stat.count, stat.time_sum, stat.time_max, stat.zero_count, buckets = state
+        stat.buckets = dict(buckets)
+        return stat
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def quantile(self, q):
+        """Returns estimation of q-quantile (0 <= q <= 1)"""
+        rank = q * (self.count - 1)
+        passed = self.zero_count
+        if rank < passed:
+            return 0.0
+        for index in sorted(self.buckets):
+            passed += self.buckets[index]
+            if rank < passed:
+                return min(2 * self.gamma ** index / (self.gamma + 1), self.time_max)
+        return self.time_max
+
+
+AGGREGATION_ENGINES = {
+    'exact': ExactStat,
+    'histogram': HistogramStat,
+}
+
+
+def get_stat_class(aggregation):
+    """Returns per-url statistic class for aggregation engine name"""
+    if aggregation not in AGGREGATION_ENGINES:
+        raise ValueError('Unknown aggregation engine "{}". Use one of: {}'.format(
+            aggregation, ', '.join(AGGREGATION_ENGINES)))
+    return AGGREGATION_ENGINES[aggregation]
+
+
+class ColumnarStat:
+    """Per-url statistic computed by numpy backend (see aggregate_columnar).
+    Keeps reference to request times sorted by url, position of url times there and precomputed values
+    (report_quantiles are quantiles for REPORT_PERCENTILES). Stored state is the same as of ExactStat"""
+
+    __slots__ = ('sorted_times', 'start', 'count', 'time_sum', 'time_max', 'time_med', 'report_quantiles')
+
+    def __init__(self, sorted_times, start, count, time_sum, time_max, time_med, report_quantiles):
+        self.sorted_times = sorted_times
+        self.start = start
+        self.count = count
+        self.time_sum = time_sum
+        self.time_max = time_max
+        self.time_med = time_med
+        self.report_quantiles = report_quantiles
+
+    @property
+    def times(self):
+        return self.sorted_times[self.start:self.start + self.count]
+
+    def merge(self, other):
+        self.sorted_times = np.sort(np.concatenate((self.times, other.times)))
+        self.start = 0
+        self.count = len(self.sorted_times)
+        self.time_sum += other.time_sum
+        self.time_max = max(self.time_max, other.time_max)
+        self.time_med = float(np.median(self.sorted_times))
+        self.report_quantiles = ()
+
+    def to_state(self):
+        return self.times.tobytes()
+
+    def median(self):
+        return self.time_med
+
+    def quantile(self, q):
+        """Returns q-quantile (0 <= q <= 1) with linear interpolation between closest ranks"""
+        for perc, value in zip(REPORT_PERCENTILES, self.report_quantiles):
+            if perc / 100 == q:
+                return value
+        times = self.times
+        pos = q * (self.count - 1)
+        low = int(pos)
+        high = min(low + 1, self.count - 1)
+        return float(times[low] + (times[high] - times[low]) * (pos - low))
+
+
+def _groups_quantile(sorted_times, starts, counts, q):
+    """Returns list of q-quantiles of groups of sorted times given by starts and counts"""
+    pos = q * (counts - 1)
+    low = pos.astype(np.int64)
+    high = np.minimum(low + 1, counts - 1)
+    low_times = sorted_times[starts + low]
+    return (low_times + (sorted_times[starts + high] - low_times) * (pos - low)).tolist()
+
+
+def aggregate_columnar(pairs, normalize=None, max_urls=None):
+    """Numpy backend of exact aggregation. Collects integer url codes and request times of
+    (url, request_time) pairs into arrays by batches, then computes count, sum, max, median and quantiles
+    of all urls with vectorized reductions over times sorted by url code.
+    Arguments are the same as for add_to_aggregate. Returns aggregate {url: ColumnarStat}"""
+    if np is None:
+        raise ImportError('numpy is required for numpy aggregation backend')
+    url_codes = {}
+    codes_batches = []
+    times_batches = []
+    pairs = iter(pairs)
+    while True:
+        batch = list(itertools.islice(pairs, COLUMNAR_BATCH_SIZE))
+        if not batch:
+            break
+        urls = list(map(operator.itemgetter(0), batch))
+        if normalize:
+            urls = list(map(normalize, urls))
+        batch_codes = list(map(url_codes.get, urls))
+        if None in batch_codes:
+            for url in dict.fromkeys(itertools.compress(urls, map(operator.is_, batch_codes, itertools.repeat(None)))):
+                if max_urls is not None and len(url_codes) >= max_urls:
+                    url_codes.setdefault(OTHER_URL, len(url_codes))
+                    break
+                url_codes[url] = len(url_codes)
+            batch_codes = list(map(url_codes.get, urls, itertools.repeat(url_codes.get(OTHER_URL))))
+        codes_batches.append(np.array(batch_codes, dtype=np.int64))
+        times_batches.append(np.fromiter(map(operator.itemgetter(1), batch), dtype=np.float64, count=len(batch)))
+    if not url_codes:
+        return {}
+
+    codes = np.concatenate(codes_batches)
+    times = np.concatenate(times_batches)
+    counts = np.bincount(codes, minlength=len(url_codes))
+    sums = np.bincount(codes, weights=times, minlength=len(url_codes)).tolist()
+    sorted_times = times[np.lexsort((times, codes))]
+    starts = np.cumsum(counts) - counts
+    maxes = sorted_times[starts + counts - 1].tolist()
+    medians = ((sorted_times[starts + (counts - 1) // 2] + sorted_times[starts + counts // 2]) / 2).tolist()
+    quantiles = zip(*[_groups_quantile(sorted_times, starts, counts, perc / 100) for perc in REPORT_PERCENTILES])
+    # codes were given to urls in order of insertion to url_codes
+    return dict(zip(url_codes, map(ColumnarStat, itertools.repeat(sorted_times), starts.tolist(), counts.tolist(),
+                                   sums, maxes, medians, quantiles)))
+
+
+NUMERIC_SEGMENT = re.compile(r'/\d+(?=/|\?|$)')
+
+
+@lru_cache(maxsize=None)
+def get_url_normalizer(rules=(), strip_query=False, collapse_numbers=False):
+    """Returns function normalizing url or None if no normalization is set.
+    Normalization strips query string, replaces numeric path segments with {id}
+    and then applies regex rules ((pattern, replacement), ...) in order.
+    Rules are compiled once, results for recent URL_CACHE_SIZE urls are cached"""
+    if not rules and not strip_query and not collapse_numbers:
+        return None
+    compiled_rules = [(re.compile(pattern), replacement) for pattern, replacement in rules]
+
+    @lru_cache(maxsize=URL_CACHE_SIZE)
+    def normalize(url):
+        if strip_query:
+            url = url.split('?', 1)[0]
+        if collapse_numbers:
+            url = NUMERIC_SEGMENT.sub('/{id}', url)
+        for regexp, replacement in compiled_rules:
+            url = regexp.sub(replacement, url)
+        return url
+
+    return normalize
+
+
+def get_url_normalization(cfg):
+    """Returns url normalization parameters of config as arguments for get_url_normalizer"""
+    return (tuple(tuple(rule) for rule in cfg['URL_RULES']),
+            bool(cfg['URL_STRIP_QUERY']), bool(cfg['URL_COLLAPSE_NUMBERS']))
+
+
+def add_to_aggregate(url_dict, pairs, stat_class, normalize=None, max_urls=None):
+    """Adds (url, request_time) pairs to aggregate {url: stat}.
+    Urls are normalized by normalize function (if given). If aggregate already has max_urls urls,
+    request of a new url is added to OTHER_URL"""
+    for url, time in pairs:
+        if normalize:
+            url = normalize(url)
+        if url not in url_dict:
+            if max_urls is not None and len(url_dict) >= max_urls:
+                url = OTHER_URL
+            if url not in url_dict:
+                url_dict[url] = stat_class()
+        url_dict[url].add(time)
+    return url_dict
+
+
+# line_urls - partial aggregate keeps urls of lines, so OTHER_URL keeps line order (see merge_aggregates)
+ParseOptions = namedtuple('ParseOptions', 'aggregation log_format url_normalization line_urls', defaults=(False, ))
 
 
-def analyse_log_file(log_filename, error_threshold=50):
-    """Parses log file and returns statistic data (list of dict).
-    Raises WrongFileToParseException if error_threshold% of lines couldn't be parsed """
+def aggregate_lines(lines, options=ParseOptions('exact', LOG_FORMAT, ())):
+    """Parses lines of log file and returns partial aggregate (see aggregate_parsed_lines)"""
+    regexp = compile_log_format(options.log_format)
+    urls = {}
+    return aggregate_parsed_lines((parse_line(s, regexp, urls) for s in lines), options)
+
+
+def aggregate_parsed_lines(parsed_lines, options):
+    """Returns partial aggregate ({url: stat}, good_parse, bad_parse, line_urls) of (url, request_time)
+    or None (bad line). line_urls is array of indexes of urls in {url: stat} for good lines if options.line_urls,
+    otherwise None"""
+    stat_class = get_stat_class(options.aggregation)
+    normalize = get_url_normalizer(*options.url_normalization)
     url_dict = {}
-    total_requests_time = 0.0
-    total_requests_count = 0
-    for (url, time) in parse_next_line(log_filename, error_threshold):
-        total_requests_time += time
-        total_requests_count += 1
+    url_indexes = {}
+    line_urls = array.array('I') if options.line_urls else None
+    good_parse = 0
+    bad_parse = 0
+    for parsed in parsed_lines:
+        if parsed is None:
+            bad_parse += 1
+            continue
+        good_parse += 1
+        url, time = parsed
+        if normalize:
+            url = normalize(url)
         if url not in url_dict:
-            url_dict[url] = [time]
+            url_dict[url] = stat_class()
+            url_indexes[url] = len(url_indexes)
+        url_dict[url].add(time)
+        if line_urls is not None:
+            line_urls.append(url_indexes[url])
+    return url_dict, good_parse, bad_parse, line_urls
+
+
+def _aggregate_file_range(task):
+    """Pool worker. Aggregates lines of plain log file in byte range [start, end)"""
+    logfile_name, start, end, options = task
+    regexp = compile_log_format(options.log_format)
+    return aggregate_parsed_lines(parse_mapped_file(logfile_name, regexp, start, end), options)
+
+
+def _aggregate_block(task):
+    """Pool worker. Aggregates lines of decompressed block of log file"""
+    block, options = task
+    return aggregate_lines(io.BytesIO(block), options)
+
+
+def split_file_to_chunks(logfile_name, chunks_count):
+    """Returns list of (start, end) byte ranges of plain file aligned to line ends"""
+    file_size = os.path.getsize(logfile_name)
+    chunk_size = max(file_size // max(chunks_count, 1) + 1, CHUNK_MIN_SIZE)
+    bounds = [0]
+    with open(logfile_name, "rb") as f:
+        while bounds[-1] + chunk_size < file_size:
+            f.seek(bounds[-1] + chunk_size)
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(file_size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def merge_aggregates(partials, max_urls=None, check_early=None):
+    """Merges partial aggregates in order. Returns ({url: stat}, good_parse, bad_parse).
+    Urls above max_urls distinct ones are merged to OTHER_URL. Exact statistic of OTHER_URL gets request times
+    in line order if partial aggregates have line_urls, so it is the same as in single process.
+    check_early(good_parse, bad_parse) is called after every partial aggregate (see ErrorThresholdCheck)"""
+    url_dict = {}
+    good_parse = 0
+    bad_parse = 0
+    for part_dict, part_good, part_bad, line_urls in partials:
+        good_parse += part_good
+        bad_parse += part_bad
+        if check_early is not None:
+            check_early(good_parse, bad_parse)
+        other_times = {}
+        for index, (url, stat) in enumerate(part_dict.items()):
+            if url not in url_dict and max_urls is not None and len(url_dict) >= max_urls:
+                if line_urls is not None and isinstance(stat, ExactStat):
+                    other_times[index] = iter(stat.times)
+                    if OTHER_URL not in url_dict:
+                        url_dict[OTHER_URL] = ExactStat()
+                    continue
+                url = OTHER_URL
+            if url not in url_dict:
+                url_dict[url] = stat
+            else:
+                url_dict[url].merge(stat)
+        if other_times:
+            url_dict[OTHER_URL].times.extend(next(other_times[index]) for index in line_urls if index in other_times)
+    return url_dict, good_parse, bad_parse
+
+
+def _ordered_pool_results(pool, func, tasks, max_pending):
+    """Generator, submits tasks to pool keeping at most max_pending of them in flight, returns results in order"""
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def aggregate_log_file_parallel(log_filename, workers, options, max_urls=None, gzip_reader='thread',
+                                check_early=None):
+    """Parses log file in pool of workers processes and returns merged aggregate.
+    check_early is called on lines parsed so far (see merge_aggregates), exception stops parsing"""
+    with multiprocessing.Pool(workers) as pool:
+        if log_filename.endswith('.gz'):
+            tasks = ((block, options) for block in LogReader(log_filename, gzip_reader, GZ_BLOCK_SIZE).blocks())
+            partials = _ordered_pool_results(pool, _aggregate_block, tasks, workers * 2)
         else:
-            url_dict[url].append(time)
-
-    stat_db = []
-    for url, reqtime_list in url_dict.items():
-        val = dict()
-        val['count'] = len(reqtime_list)
-        val['time_sum'] = sum(reqtime_list)
-        val['time_max'] = max(reqtime_list)
-        val['time_avg'] = val['time_sum'] / val['count']
-        val['url'] = url
-        val['time_med'] = median(reqtime_list)
-        val['time_perc'] = val['time_sum'] * 100 / total_requests_time
-        val['count_perc'] = len(reqtime_list) * 100 / total_requests_count
-        stat_db.append(val)
-    return stat_db
-
-
-def generate_report(data, report_template, report_filename, report_size=None):
-    """Writes report of statistic data to file. """
-    if report_size is None:
-        report_size = len(data)
-    if report_size < len(data):
-        selected = sorted(data, key=lambda p: p['time_sum'], reverse=True)
-        data = selected[:report_size]
-
-    # converts floats to string for better view in report
-    for d in data:
-        d['time_med'] = "%.3f" % (d['time_med'])
-        d['time_perc'] = "%.3f" % (d['time_perc'])
-        d['time_avg'] = "%.3f" % (d['time_avg'])
-        d['count_perc'] = "%.3f" % (d['count_perc'])
-        d['time_sum'] = "%.3f" % (d['time_sum'])
-
-    json_str = json.dumps(data)
+            tasks = [(log_filename, start, end, options)
+                     for start, end in split_file_to_chunks(log_filename, workers * 4)]
+            partials = _ordered_pool_results(pool, _aggregate_file_range, tasks, workers * 2)
+        return merge_aggregates(partials, max_urls, check_early)
+
+
+# Fields of statistic data row of url
+STAT_FIELDS = ('count', 'time_sum', 'time_max', 'time_avg', 'url', 'time_med') + \
+    tuple('time_p%d' % perc for perc in REPORT_PERCENTILES) + ('time_perc', 'count_perc')
+
+
+class StatRow(namedtuple('StatRow', STAT_FIELDS)):
+    """Statistic data row of url. Tuple with named fields, which could be read as mapping too
+    (row['url'], dict(row)), so rows take several times less memory than dicts"""
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return getattr(self, key) if isinstance(key, str) else tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def keys(self):
+        return self._fields
+
+
+def iter_statistic(url_dict):
+    """Generator, returns statistic data (StatRow) for every url of aggregate {url: stat}"""
+    total_requests_count = sum(stat.count for stat in url_dict.values())
+    total_requests_time = sum(stat.time_sum for stat in url_dict.values())
+    for url, stat in url_dict.items():
+        count = stat.count
+        time_sum = stat.time_sum
+        yield StatRow(count, time_sum, stat.time_max, time_sum / count, url, stat.median(),
+                      *(stat.quantile(perc / 100) for perc in REPORT_PERCENTILES),
+                      time_sum * 100 / total_requests_time if total_requests_time else 0.0,
+                      count * 100 / total_requests_count)
+
+
+def make_statistic(url_dict):
+    """Returns statistic data (list of StatRow) for aggregate {url: stat}"""
+    return list(iter_statistic(url_dict))
+
+
+def aggregate_log_file(log_filename, error_threshold=50, workers=1, aggregation='exact', log_format=LOG_FORMAT,
+                       url_normalization=(), max_urls=None, gzip_reader='thread', backend='python',
+                       error_check=(ERROR_CHECK_MIN_LINES, ERROR_CHECK_CONFIDENCE)):
+    """Parses log file and returns aggregate {url: stat}. Parameters are the same as for analyse_log_file"""
+    stat_class = get_stat_class(aggregation)
+    compile_log_format(log_format)
+    normalize = get_url_normalizer(*url_normalization)
+    if backend not in AGGREGATION_BACKENDS:
+        raise ValueError('Unknown aggregation backend "{}". Use one of: {}'.format(
+            backend, ', '.join(AGGREGATION_BACKENDS)))
+    if backend == 'numpy' and aggregation == 'exact' and workers <= 1:
+        return aggregate_columnar(parse_next_line(log_filename, error_threshold, log_format, gzip_reader,
+                                                  error_check), normalize, max_urls)
+    if workers > 1:
+        options = ParseOptions(aggregation, log_format, url_normalization, max_urls is not None)
+        url_dict, good_parse, bad_parse = aggregate_log_file_parallel(
+            log_filename, workers, options, max_urls, gzip_reader, ErrorThresholdCheck(error_threshold, *error_check))
+        logging.debug('{} lines parsed from {}'.format(good_parse, good_parse + bad_parse))
+        check_error_threshold(good_parse, bad_parse, error_threshold)
+        return url_dict
+
+    return add_to_aggregate({}, parse_next_line(log_filename, error_threshold, log_format, gzip_reader, error_check),
+                            stat_class, normalize, max_urls)
+
+
+def analyse_log_file(log_filename, error_threshold=50, workers=1, aggregation='exact', log_format=LOG_FORMAT,
+                     url_normalization=(), max_urls=None, gzip_reader='thread', backend='python',
+                     error_check=(ERROR_CHECK_MIN_LINES, ERROR_CHECK_CONFIDENCE)):
+    """Parses log file and returns statistic data (list of StatRow).
+    Raises WrongFileToParseException if error_threshold% of lines couldn't be parsed.
+    If workers > 1, file is parsed by chunks in pool of processes.
+    aggregation is the name of per-url statistic engine (see AGGREGATION_ENGINES),
+    log_format is nginx log_format string of the file,
+    url_normalization is tuple of get_url_normalizer arguments,
+    max_urls limits number of distinct urls, requests of other urls are counted as OTHER_URL,
+    gzip_reader is the way to decompress gz file (see LogReader),
+    backend 'numpy' computes exact aggregation in one process by aggregate_columnar,
+    error_check is (min_lines, confidence) of early error threshold check (see ErrorThresholdCheck)"""
+    return make_statistic(aggregate_log_file(log_filename, error_threshold, workers, aggregation, log_format,
+                                             url_normalization, max_urls, gzip_reader, backend, error_check))
+
+
+class SeriesStat:
+    """Per-url statistic with time series. Adds (request_time, timestamp) to stat and to HistogramStat
+    of bucket_size seconds bucket {bucket start timestamp: HistogramStat}"""
+
+    __slots__ = ('stat', 'bucket_size', 'buckets')
+
+    def __init__(self, stat, bucket_size):
+        self.stat = stat
+        self.bucket_size = bucket_size
+        self.buckets = {}
+
+    def add(self, timed):
+        time, timestamp = timed
+        self.stat.add(time)
+        bucket = timestamp - timestamp % self.bucket_size
+        if bucket not in self.buckets:
+            self.buckets[bucket] = HistogramStat()
+        self.buckets[bucket].add(time)
+
+
+def get_series_bucket(value):
+    """Returns size of time series bucket in seconds for config value: seconds or string like '1m', '5m', '1h'"""
+    match = re.fullmatch(r'(\d+)([smh]?)', str(value))
+    if not match or not int(match.group(1)):
+        raise ValueError('Wrong series bucket "{}". Use seconds or number with suffix s, m or h'.format(value))
+    return int(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600}[match.group(2)]
+
+
+def aggregate_log_series(log_filename, bucket_size, error_threshold=50, aggregation='exact', log_format=LOG_FORMAT,
+                         url_normalization=(), max_urls=None, gzip_reader='thread',
+                         error_check=(ERROR_CHECK_MIN_LINES, ERROR_CHECK_CONFIDENCE)):
+    """Parses log file in one process and returns aggregate {url: stat} and time series
+    {url: {bucket start timestamp: HistogramStat}} of bucket_size seconds buckets, so memory per bucket is bounded.
+    Series of all requests is SERIES_ALL. max_urls is required, because series are kept for every url
+    until the end of file. Other parameters are the same as for analyse_log_file"""
+    if max_urls is None:
+        raise ValueError('URL_MAX_COUNT should be set to build time series')
+    stat_class = get_stat_class(aggregation)
+    all_series = SeriesStat(HistogramStat(), bucket_size)
+
+    def timed_pairs():
+        for url, time, timestamp in parse_next_line(log_filename, error_threshold, log_format, gzip_reader,
+                                                    error_check, with_time=True):
+            all_series.add((time, timestamp))
+            yield url, (time, timestamp)
+
+    series_dict = add_to_aggregate({}, timed_pairs(), lambda: SeriesStat(stat_class(), bucket_size),
+                                   get_url_normalizer(*url_normalization), max_urls)
+    series = {SERIES_ALL: all_series.buckets}
+    series.update((url, stat.buckets) for url, stat in series_dict.items())
+    return {url: stat.stat for url, stat in series_dict.items()}, series
+
+
+def iter_series(url_dict, series, report_size=None):
+    """Generator, returns time series rows (dict) ordered by time: of all requests (SERIES_ALL) and then of
+    report_size urls with the largest time_sum (of all urls if report_size is None)"""
+    urls = list(url_dict) if report_size is None else \
+        heapq.nlargest(report_size, url_dict, key=lambda url: url_dict[url].time_sum)
+    for url in [SERIES_ALL] + urls:
+        buckets = series[url]
+        for bucket in sorted(buckets):
+            stat = buckets[bucket]
+            row = {'url': url, 'time': datetime.fromtimestamp(bucket, timezone.utc).isoformat(), 'timestamp': bucket,
+                   'count': stat.count, 'time_sum': stat.time_sum, 'time_max': stat.time_max,
+                   'time_avg': stat.time_sum / stat.count, 'time_med': stat.median()}
+            for perc in REPORT_PERCENTILES:
+                row['time_p%d' % perc] = stat.quantile(perc / 100)
+            yield row
+
+
+def write_series_report(rows, report_filename):
+    """Writes time series rows as JSON lines atomically"""
+    tmp_filename = report_filename + '.tmp'
+    try:
+        with open(tmp_filename, 'w', encoding='utf-8') as of:
+            for row in rows:
+                of.write(json.dumps(row))
+                of.write('\n')
+        os.replace(tmp_filename, report_filename)
+    finally:
+        if exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def get_state_filename(report_dir, date):
+    """Returns name of file with aggregate state of log file for date"""
+    return join(report_dir, STATE_DIR_NAME, 'state-' + date.strftime('%Y-%m-%d') + '.bin.gz')
+
+
+def save_state(state_filename, url_dict, aggregation):
+    """Writes aggregate {url: stat} to gzipped file: JSON header line with urls and their states followed
+    by binary states. Binary state (bytes of array of doubles of exact statistic) is given in header by its size
+    and written as is, so request times are neither formatted nor parsed"""
+    os.makedirs(os.path.dirname(state_filename), exist_ok=True)
+    states = [(url, stat.to_state()) for url, stat in url_dict.items()]
+    header = {'aggregation': aggregation, 'byteorder': sys.byteorder,
+              'urls': [[url, len(state)] if isinstance(state, bytes) else [url, None, state] for url, state in states]}
+    tmp_filename = state_filename + '.tmp'
+    with gzip.open(tmp_filename, 'wb', compresslevel=STATE_COMPRESS_LEVEL) as f:
+        f.write(json.dumps(header, separators=(',', ':')).encode() + b'\n')
+        f.writelines(state for _, state in states if isinstance(state, bytes))
+    os.replace(tmp_filename, state_filename)
+
+
+def load_state(state_filename):
+    """Reads aggregate state file written by save_state. Returns (aggregation, {url: stat})"""
+    with gzip.open(state_filename, 'rb') as f:
+        header = json.loads(f.readline())
+        data = memoryview(f.read())
+    stat_class = get_stat_class(header['aggregation'])
+    url_dict = {}
+    offset = 0
+    for url, size, *state in header['urls']:
+        if size is None:
+            url_dict[url] = stat_class.from_state(state[0])
+            continue
+        times = data[offset:offset + size]
+        offset += size
+        if header['byteorder'] != sys.byteorder:
+            swapped = array.array('d')
+            swapped.frombytes(times)
+            swapped.byteswap()
+            times = swapped.tobytes()
+        url_dict[url] = stat_class.from_state(times)
+    return header['aggregation'], url_dict
+
+
+def get_stored_states(report_dir):
+    """Returns list of (date, state_filename) of stored aggregate states sorted by date"""
+    state_dir = join(report_dir, STATE_DIR_NAME)
+    if not exists(state_dir):
+        return []
+    states = []
+    for file_name in os.listdir(state_dir):
+        match = re.fullmatch(r'state-(\d{4}-\d{2}-\d{2})\.bin\.gz', file_name)
+        if match:
+            states.append((datetime.strptime(match.group(1), '%Y-%m-%d'), join(state_dir, file_name)))
+    return sorted(states)
+
+
+def get_rollup_period(date, period):
+    """Returns (first_date, last_date, label) of calendar week or month containing date"""
+    if period == 'week':
+        first_date = date - timedelta(days=date.weekday())
+        year, week, _ = date.isocalendar()
+        return first_date, first_date + timedelta(days=6), '{}-W{:02d}'.format(year, week)
+    first_date = date.replace(day=1)
+    next_month = (first_date + timedelta(days=31)).replace(day=1)
+    return first_date, next_month - timedelta(days=1), date.strftime('%Y-%m')
+
+
+def rollup_states(report_dir, period, aggregation):
+    """Merges stored states of the period ('week' or 'month') containing the latest stored state.
+    Returns (label, {url: stat}) or (None, None) if there are no stored states"""
+    states = get_stored_states(report_dir)
+    if not states:
+        return None, None
+    first_date, last_date, label = get_rollup_period(states[-1][0], period)
+    url_dict = {}
+    for date, state_filename in states:
+        if not first_date <= date <= last_date:
+            continue
+        state_aggregation, state_dict = load_state(state_filename)
+        if state_aggregation != aggregation:
+            logging.warning('State {} is skipped: aggregation "{}" differs from "{}"'.format(
+                state_filename, state_aggregation, aggregation))
+            continue
+        for url, stat in state_dict.items():
+            if url not in url_dict:
+                url_dict[url] = stat
+            else:
+                url_dict[url].merge(stat)
+    return label, url_dict
+
+
+class LogFollower:
+    """Reads lines appended to log file by blocks of buffer_size bytes, so memory doesn't depend on file size.
+    Rotated (replaced or truncated) file is detected by is_rotated and should be closed after it is read to the end"""
+
+    def __init__(self, logfile_name, buffer_size=READ_BUFFER_SIZE):
+        self.logfile_name = logfile_name
+        self.buffer_size = buffer_size
+        self.file = None
+        self.inode = None
+        self.rest = b''
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        self.file = None
+        self.rest = b''
+
+    def read_lines(self):
+        """Returns list of complete lines (without line ends) of next block of appended data.
+        Empty list means there is no new complete line yet"""
+        if not self.file:
+            try:
+                self.file = open(self.logfile_name, 'rb')
+            except FileNotFoundError:
+                return []
+            self.inode = os.fstat(self.file.fileno()).st_ino
+        data = self.file.read(self.buffer_size)
+        if not data:
+            return []
+        lines = (self.rest + data).split(b'\n')
+        self.rest = lines.pop()
+        return lines
 
+    def is_rotated(self):
+        """Returns True if opened log file was rotated. Lines written to it before rotation can still be read,
+        after that file should be closed, so next read_lines starts the new file"""
+        if not self.file:
+            return False
+        try:
+            st = os.stat(self.logfile_name)
+        except FileNotFoundError:
+            return False
+        return st.st_ino != self.inode or st.st_size < self.file.tell()
+
+
+def follow_log_file(cfg, max_reports=None):
+    """Follows current log file and every FOLLOW_INTERVAL seconds regenerates report-live.html in REPORT_DIR.
+    Statistic is collected with HistogramStat to keep memory per url bounded, URL_MAX_COUNT is required
+    to bound number of urls. Statistic is reset when log is rotated: rotated file is read to the end and
+    reported first. Stops after max_reports reports (if given)"""
+    if cfg['URL_MAX_COUNT'] is None:
+        raise ValueError('URL_MAX_COUNT should be set to follow log file')
+    follower = LogFollower(join(cfg['LOG_DIR'], cfg['FOLLOW_FILENAME']))
+    regexp = compile_log_format(cfg['LOG_FORMAT'])
+    normalize = get_url_normalizer(*get_url_normalization(cfg))
+    report_filename = get_report_filename(cfg['REPORT_DIR'], 'live', cfg['REPORT_FORMATS'][0])
+    url_dict = {}
+    bad_parse = 0
+    next_report_time = time.monotonic() + cfg['FOLLOW_INTERVAL']
+    reports_count = 0
+    try:
+        while max_reports is None or reports_count < max_reports:
+            # rotation is checked before reading, so lines written to rotated file before rotation are read
+            rotated = follower.is_rotated()
+            lines = follower.read_lines()
+            pairs = [parsed for parsed in (parse_line(s, regexp) for s in lines) if parsed is not None]
+            bad_parse += len(lines) - len(pairs)
+            add_to_aggregate(url_dict, pairs, HistogramStat, normalize, cfg['URL_MAX_COUNT'])
+
+            if time.monotonic() >= next_report_time:
+                if url_dict:
+                    write_reports(cfg, url_dict, report_filename)
+                    logging.debug('Live report was updated, {} lines were not parsed'.format(bad_parse))
+                reports_count += 1
+                next_report_time = time.monotonic() + cfg['FOLLOW_INTERVAL']
+
+            if lines:
+                continue
+            if rotated:
+                if url_dict:
+                    write_reports(cfg, url_dict, report_filename)
+                logging.info('Log file {} was rotated, statistic is reset'.format(follower.logfile_name))
+                follower.close()
+                url_dict = {}
+                bad_parse = 0
+            elif max_reports is None or reports_count < max_reports:
+                time.sleep(FOLLOW_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        logging.info('Following log file was stopped')
+    finally:
+        follower.close()
+
+
+# Marker substituted for $table_json to split report template around the table
+TABLE_JSON_MARKER = '\x00table_json\x00'
+
+
+def format_report_row(d):
+    """Returns copy of statistic data row with floats converted to strings for better view in report"""
+    row = dict(d)
+    for key in ('time_med', 'time_perc', 'time_avg', 'count_perc', 'time_sum') + \
+            tuple('time_p%d' % perc for perc in REPORT_PERCENTILES):
+        row[key] = "%.3f" % (row[key])
+    return row
+
+
+def select_top(data, report_size):
+    """Returns report_size rows of statistic data with the largest time_sum, ordered by time_sum.
+    Uses heap, so data is not sorted as a whole and could be an iterator"""
+    return heapq.nlargest(report_size, data, key=lambda p: p['time_sum'])
+
+
+def write_table_json(of, rows):
+    """Writes rows to file as JSON array one by one (the same text as json.dumps(list(rows)))"""
+    of.write('[')
+    for i, row in enumerate(rows):
+        if i:
+            of.write(', ')
+        of.write(json.dumps(row))
+    of.write(']')
+
+
+def write_html_report(rows, report_filename, report_template):
+    """Writes html report from template with rows inlined as $table_json"""
     with open(report_template, 'r', encoding='utf-8') as tf:
         template = Template(tf.read())
+    head, tail = template.safe_substitute(table_json=TABLE_JSON_MARKER).split(TABLE_JSON_MARKER, 1)
     with open(report_filename, 'w', encoding='utf-8') as of:
-        of.write(template.safe_substitute(table_json=json_str))
+        of.write(head)
+        write_table_json(of, (format_report_row(d) for d in rows))
+        of.write(tail)
+
+
+# Number of rows on page of paged html report
+REPORT_PAGE_SIZE = 1000
+
+
+def get_report_pages_dir(report_filename):
+    """Returns name of folder with pages of paged html report (report-YYYY-MM-DD-pages for
+    report-YYYY-MM-DD.html, also when report is written to temporary file)"""
+    return join(os.path.dirname(report_filename), os.path.basename(report_filename).split('.')[0] + '-pages')
+
+
+def write_paged_html_report(rows, report_filename, report_template):
+    """Writes html report with the first REPORT_PAGE_SIZE rows inlined as $table_json. Other rows are written
+    by pages of REPORT_PAGE_SIZE rows to sidecar folder (see get_report_pages_dir) as JSON wrapped in
+    reportPage(page, rows) call, so page loads them on demand by script tag (works for report opened from disk).
+    Rows are streamed, only one page is kept in memory"""
+    pages_dir = get_report_pages_dir(report_filename)
+    tmp_dir = pages_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    rows = (format_report_row(d) for d in rows)
+    first_page = list(itertools.islice(rows, REPORT_PAGE_SIZE))
+    rows_count = len(first_page)
+    pages_count = 1
+    while True:
+        page = list(itertools.islice(rows, REPORT_PAGE_SIZE))
+        if not page:
+            break
+        with open(join(tmp_dir, 'page-{}.js'.format(pages_count)), 'w', encoding='utf-8') as of:
+            of.write('reportPage({}, '.format(pages_count))
+            write_table_json(of, page)
+            of.write(');\n')
+        rows_count += len(page)
+        pages_count += 1
+    shutil.rmtree(pages_dir, ignore_errors=True)
+    os.replace(tmp_dir, pages_dir)
+
+    with open(report_template, 'r', encoding='utf-8') as tf:
+        template = Template(tf.read())
+    with open(report_filename, 'w', encoding='utf-8') as of:
+        of.write(template.safe_substitute(table_json=json.dumps(first_page), pages_dir=os.path.basename(pages_dir),
+                                          pages_count=pages_count, rows_count=rows_count))
+
+
+def write_jsonl_report(rows, report_filename, report_template=None):
+    """Writes report as JSON lines: object with STAT_FIELDS for every row"""
+    with open(report_filename, 'w', encoding='utf-8') as of:
+        for row in rows:
+            of.write(json.dumps({field: row[field] for field in STAT_FIELDS}))
+            of.write('\n')
+
+
+def write_csv_report(rows, report_filename, report_template=None):
+    """Writes report as CSV with header of STAT_FIELDS"""
+    with open(report_filename, 'w', encoding='utf-8', newline='') as of:
+        writer = csv.writer(of)
+        writer.writerow(STAT_FIELDS)
+        writer.writerows([row[field] for field in STAT_FIELDS] for row in rows)
+
+
+# Compact binary columnar report: COLUMNAR_REPORT_MAGIC, header (uint32 length and
+# JSON {"columns": [[name, type], ...]}), then groups of up to COLUMNAR_REPORT_GROUP_SIZE rows: uint32 number
+# of rows and columns one after another (int64 and float64 values, utf8 strings as uint32 lengths and bytes).
+# Group of 0 rows ends the file. All numbers are little-endian
+COLUMNAR_REPORT_MAGIC = b'LACOL1\n'
+COLUMNAR_REPORT_GROUP_SIZE = 1 << 16
+COLUMNAR_REPORT_TYPES = {'int64': 'q', 'float64': 'd', 'utf8': 'I'}
+COLUMNAR_REPORT_COLUMNS = [(field, 'int64' if field == 'count' else 'utf8' if field == 'url' else 'float64')
+                           for field in STAT_FIELDS]
+
+
+def _little_endian(values):
+    """Returns bytes of array in little-endian order"""
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def write_columnar_report(rows, report_filename, report_template=None):
+    """Writes report in compact binary columnar format (see COLUMNAR_REPORT_MAGIC), rows are buffered by groups"""
+    header = json.dumps({'columns': COLUMNAR_REPORT_COLUMNS}).encode()
+    with open(report_filename, 'wb') as of:
+        of.write(COLUMNAR_REPORT_MAGIC + struct.pack('<I', len(header)) + header)
+        rows = iter(rows)
+        while True:
+            group = list(itertools.islice(rows, COLUMNAR_REPORT_GROUP_SIZE))
+            of.write(struct.pack('<I', len(group)))
+            if not group:
+                break
+            for field, column_type in COLUMNAR_REPORT_COLUMNS:
+                if column_type == 'utf8':
+                    values = [row[field].encode('utf-8') for row in group]
+                    of.write(_little_endian(array.array('I', map(len, values))))
+                    of.write(b''.join(values))
+                else:
+                    values = array.array(COLUMNAR_REPORT_TYPES[column_type], (row[field] for row in group))
+                    of.write(_little_endian(values))
+
+
+def read_columnar_report(report_filename):
+    """Reads report in binary columnar format. Returns {column name: list of values}"""
+    with open(report_filename, 'rb') as f:
+        if f.read(len(COLUMNAR_REPORT_MAGIC)) != COLUMNAR_REPORT_MAGIC:
+            raise ValueError('{} is not columnar report'.format(report_filename))
+        header_size, = struct.unpack('<I', f.read(4))
+        columns = json.loads(f.read(header_size).decode())['columns']
+        result = {name: [] for name, _ in columns}
+        while True:
+            count, = struct.unpack('<I', f.read(4))
+            if not count:
+                return result
+            for name, column_type in columns:
+                values = array.array(COLUMNAR_REPORT_TYPES[column_type])
+                values.frombytes(f.read(values.itemsize * count))
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                if column_type == 'utf8':
+                    result[name].extend(f.read(size).decode('utf-8') for size in values)
+                else:
+                    result[name].extend(values)
+
+
+REPORT_WRITERS = {
+    'html': write_html_report,
+    'html_paged': write_paged_html_report,
+    'jsonl': write_jsonl_report,
+    'csv': write_csv_report,
+    'columnar': write_columnar_report,
+}
+
+REPORT_EXTENSIONS = {'html': '.html', 'html_paged': '.html', 'jsonl': '.jsonl', 'csv': '.csv', 'columnar': '.lacol'}
+# Templates of report formats in TEMPLATE_DIR
+REPORT_TEMPLATES = {'html': 'report.html', 'html_paged': 'report_paged.html'}
+
+
+def get_report_writer(report_format):
+    """Returns report writer function by format name"""
+    try:
+        return REPORT_WRITERS[report_format]
+    except KeyError:
+        raise ValueError('Unknown report format "{}". Use one of: {}'.format(
+            report_format, ', '.join(REPORT_WRITERS))) from None
+
+
+def check_report_formats(report_formats):
+    """Raises ValueError if report format is unknown or reports of two formats would be written to the same file
+    (as html and html_paged)"""
+    extensions = {}
+    for report_format in report_formats:
+        get_report_writer(report_format)
+        extension = REPORT_EXTENSIONS[report_format]
+        if extension in extensions and extensions[extension] != report_format:
+            raise ValueError('Report formats "{}" and "{}" are written to the same {} file. Use one of them'.format(
+                extensions[extension], report_format, extension))
+        extensions[extension] = report_format
+
+
+def generate_report(data, report_template, report_filename, report_size=None, report_format='html'):
+    """Writes report of statistic data (iterable of StatRow or dict) to file in report_format (see REPORT_WRITERS).
+    If report_size is given, only report_size rows with the largest time_sum are written, otherwise
+    rows are streamed to file as they come. """
+    writer = get_report_writer(report_format)
+    if report_size is not None:
+        data = select_top(data, report_size)
+    writer(data, report_filename, report_template)
+
+
+def get_report_filename(report_dir, label, report_format='html'):
+    """Returns name of report of log file for date label (or of rollup period label)"""
+    return join(report_dir, 'report-' + label + REPORT_EXTENSIONS[report_format])
+
+
+def write_reports(cfg, url_dict, report_filename):
+    """Writes reports of aggregate {url: stat} in every format of REPORT_FORMATS atomically (through temporary
+    files). report_filename is name of report in the first format, other reports differ by extension"""
+    for report_format in cfg['REPORT_FORMATS']:
+        file_name = os.path.splitext(report_filename)[0] + REPORT_EXTENSIONS[report_format]
+        tmp_filename = file_name + '.tmp'
+        try:
+            report_template = join(cfg['TEMPLATE_DIR'], REPORT_TEMPLATES.get(report_format, ''))
+            generate_report(iter_statistic(url_dict), report_template, tmp_filename, cfg['REPORT_SIZE'], report_format)
+            os.replace(tmp_filename, file_name)
+        finally:
+            if exists(tmp_filename):
+                os.remove(tmp_filename)
+
+
+def report_log_file(cfg, file_info, report_filename, workers=None, reuse_state=True):
+    """Analyses log file (or uses its stored state if INCREMENTAL and reuse_state) and writes reports atomically.
+    reuse_state should be False if log file was changed after its state was stored.
+    If SERIES_BUCKET is set, log file is parsed in one process to write time series report too"""
+    state_filename = get_state_filename(cfg['REPORT_DIR'], file_info.date)
+    series = None
+    if cfg['INCREMENTAL'] and reuse_state and exists(state_filename) and not cfg['SERIES_BUCKET']:
+        logging.info('Using stored state ' + state_filename)
+        _, url_dict = load_state(state_filename)
+    else:
+        logging.info('Analysing file ' + file_info.path)
+        if cfg['SERIES_BUCKET']:
+            url_dict, series = aggregate_log_series(file_info.path, get_series_bucket(cfg['SERIES_BUCKET']),
+                                                    aggregation=cfg['AGGREGATION'], log_format=cfg['LOG_FORMAT'],
+                                                    url_normalization=get_url_normalization(cfg),
+                                                    max_urls=cfg['URL_MAX_COUNT'], gzip_reader=cfg['GZIP_READER'],
+                                                    error_check=get_error_check(cfg))
+        else:
+            url_dict = aggregate_log_file(file_info.path, workers=cfg['WORKERS'] if workers is None else workers,
+                                          aggregation=cfg['AGGREGATION'], log_format=cfg['LOG_FORMAT'],
+                                          url_normalization=get_url_normalization(cfg),
+                                          max_urls=cfg['URL_MAX_COUNT'], gzip_reader=cfg['GZIP_READER'],
+                                          backend=cfg['AGGREGATION_BACKEND'], error_check=get_error_check(cfg))
+        if cfg['INCREMENTAL']:
+            save_state(state_filename, url_dict, cfg['AGGREGATION'])
+            logging.info('State was stored to ' + state_filename)
+
+    write_reports(cfg, url_dict, report_filename)
+    if series is not None:
+        write_series_report(iter_series(url_dict, series, cfg['REPORT_SIZE']),
+                            os.path.splitext(report_filename)[0] + '-series.jsonl')
+
+
+def get_unreported_log_files(cfg, index=None):
+    """Returns list of (FileDescription, report_filename) of log files in LOG_DIR without reports
+    (or changed after report if index is given) sorted by date. Only one file of a date is returned"""
+    if index is not None:
+        index.update()
+        files = ((join(cfg['LOG_DIR'], name), datetime.strptime(val[0], '%Y%m%d')) for name, val in index.files.items())
+    else:
+        files = ((join(cfg['LOG_DIR'], entry.name), date) for entry, date in iter_log_dir(cfg['LOG_DIR']))
+    dates = {}
+    for path, date in files:
+        dates.setdefault(date, FileDescription(path, date))
+    result = []
+    for date, file_info in sorted(dates.items()):
+        report_filename = get_report_filename(cfg['REPORT_DIR'], date.strftime('%Y-%m-%d'), cfg['REPORT_FORMATS'][0])
+        if not exists(report_filename) or (index is not None and index.is_changed(file_info.path)):
+            result.append((file_info, report_filename))
+    return result
+
+
+def _backfill_task(task):
+    """Worker of backfill: reports log file. Returns (file_info, report_filename, error message or None)"""
+    cfg, file_info, report_filename, reuse_state = task
+    try:
+        report_log_file(cfg, file_info, report_filename, workers=1, reuse_state=reuse_state)
+    except Exception as ex:
+        return file_info, report_filename, '{}: {}'.format(type(ex).__name__, ex)
+    return file_info, report_filename, None
+
+
+def backfill_reports(cfg, index=None):
+    """Reports every log file of LOG_DIR without report in pool of WORKERS processes (every file is parsed
+    by one process). Error of a file (e.g. error threshold exceeded) is logged and doesn't stop the others.
+    Returns (reported, failed) lists of log file paths"""
+    tasks = [(cfg, file_info, report_filename, index is None or not index.is_changed(file_info.path))
+             for file_info, report_filename in get_unreported_log_files(cfg, index)]
+    logging.info('{} log files without reports found'.format(len(tasks)))
+    reported, failed = [], []
+    workers = min(cfg['WORKERS'], len(tasks))
+    with (multiprocessing.Pool(workers) if workers > 1 else contextlib.nullcontext()) as pool:
+        results = pool.imap_unordered(_backfill_task, tasks) if pool else map(_backfill_task, tasks)
+        for file_info, report_filename, error in results:
+            if error is None:
+                logging.info('Report was generated to ' + report_filename)
+                reported.append(file_info.path)
+                if index is not None:
+                    index.set_reported(file_info.path)
+            else:
+                logging.error('Log file {} was not reported. {}'.format(file_info.path, error))
+                failed.append(file_info.path)
+    if index is not None:
+        index.save()
+    return reported, failed
 
 
 def main(default_cfg):
     try:
         # Starting up
-        cfg = reload_config(get_config_filename(), default_cfg)
+        args = get_command_line_args()
+        cfg = apply_command_line_args(reload_config(args.config, default_cfg), args)
         setup_logger(cfg["LOGGER_FILENAME"])
     except Exception as ex:
         logging.error('Configuration load failure: ' + str(ex))
@@ -175,7 +1717,9 @@ def main(default_cfg):
     try:
         # Checking needed folders and files exists
 
-        for checked_file in [join(cfg['TEMPLATE_DIR'], x) for x in ('report.html', )]:
+        check_report_formats(cfg['REPORT_FORMATS'])
+        for checked_file in [join(cfg['TEMPLATE_DIR'], REPORT_TEMPLATES[x]) for x in cfg['REPORT_FORMATS']
+                             if x in REPORT_TEMPLATES]:
             if not exists(checked_file):
                 logging.error(' File required for report generation not found {}.', checked_file)
                 raise FileNotFoundError(checked_file)
@@ -188,25 +1732,52 @@ def main(default_cfg):
         if not exists(cfg["REPORT_DIR"]):
             os.mkdir(cfg["REPORT_DIR"])
 
+        if args.follow:
+            logging.info('Following log file ' + join(cfg['LOG_DIR'], cfg['FOLLOW_FILENAME']))
+            follow_log_file(cfg)
+            return
+
+        if args.rollup:
+            label, url_dict = rollup_states(cfg['REPORT_DIR'], args.rollup, cfg['AGGREGATION'])
+            if not url_dict:
+                logging.info('No stored states found to build {} report.'.format(args.rollup))
+                return
+            report_filename = get_report_filename(cfg['REPORT_DIR'], label, cfg['REPORT_FORMATS'][0])
+            write_reports(cfg, url_dict, report_filename)
+            logging.info('Report for {} {} was generated to {}'.format(args.rollup, label, report_filename))
+            return
+
+        index = LogIndex.load(get_log_index_filename(cfg['REPORT_DIR']), cfg['LOG_DIR']) if cfg['LOG_INDEX'] else None
+        if args.backfill:
+            reported, failed = backfill_reports(cfg, index)
+            logging.info('Backfill is done: {} reports were generated, {} log files failed'.format(
+                len(reported), len(failed)))
+            return
+
         # Looking for file to parse
-        file_info = get_latest_logfile_info(cfg['LOG_DIR'])
+        file_info = get_latest_logfile_info(cfg['LOG_DIR'], index)
+        if index is not None:
+            index.save()
         if not file_info.path:
             logging.info('No file found to analyse.')
             return
 
-        report_filename = join(cfg["REPORT_DIR"], 'report-' + file_info.date.strftime('%Y-%m-%d') + '.html')
-        if exists(report_filename):
+        report_filename = get_report_filename(cfg['REPORT_DIR'], file_info.date.strftime('%Y-%m-%d'),
+                                              cfg['REPORT_FORMATS'][0])
+        if index is not None and exists(report_filename) and index.is_changed(file_info.path):
+            logging.info('Log file {} was changed after report, report is regenerated'.format(file_info.path))
+        elif exists(report_filename):
             logging.info('Report for latest nginx-log file ({0}) have been already done. '
                          'Check it in file {1}.'.format(file_info.path, report_filename))
             return
 
-        # Analysing
-        logging.info('Analysing file ' + file_info.path)
-        statistic_db = analyse_log_file(file_info.path)
-
-        # Reporting
-        generate_report(statistic_db, join(cfg['TEMPLATE_DIR'], 'report.html'), report_filename, cfg['REPORT_SIZE'])
+        # Analysing and reporting (stored state of changed log file is outdated too)
+        reuse_state = index is None or not index.is_changed(file_info.path)
+        report_log_file(cfg, file_info, report_filename, reuse_state=reuse_state)
         logging.info('Report was generated to ' + report_filename)
+        if index is not None:
+            index.set_reported(file_info.path)
+            index.save()
 
 
     except UserWarning as uw:
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks of log_analyzer. Run from log_analyzer folder: python log_analyzer_bench.py --help"""
+
+import argparse
+import cProfile
+import glob
+import gzip
+import os
+import pstats
+import random
+import re
+import resource
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+import log_analyzer as la
+
+SAMPLE_LOG = './tests/log_plain/nginx-access-ui.log-20190103'
+
+LEGACY_REGEXP_URL = re.compile(r'((GET)|(POST)|(HEAD)|(PUT)|(OPTIONS)|(CONNECT)|(TRACE)|(PATCH)|(DELETE))'
+                               r' .+ HTTP/\d\.\d')
+LEGACY_REGEXP_TIME = re.compile(r'" \d+\.\d{1,3}\s')
+
+
+def legacy_parse_line(s):
+    """Two-regex line parser used before log_format parser was introduced"""
+    line = s.decode(encoding='utf-8')
+    match_url = LEGACY_REGEXP_URL.search(line)
+    if not match_url:
+        return None
+    url = match_url.group().split(sep=' ')[1]
+    match_time = LEGACY_REGEXP_TIME.search(line, match_url.span()[1])
+    if not match_time:
+        return None
+    return url, float(match_time.group()[2:-1])
+
+
+def load_sample_lines(count):
+    """Returns list of count lines repeated from sample log file"""
+    with open(SAMPLE_LOG, 'rb') as f:
+        sample = f.readlines()
+    return (sample * (count // len(sample) + 1))[:count]
+
+
+def bench_parse_line(lines):
+    """Prints lines/sec of legacy and log_format line parsers"""
+    regexp = la.compile_log_format(la.LOG_FORMAT)
+    for name, parse in (('legacy two regex', legacy_parse_line),
+                        ('log_format regex', lambda s: la.parse_line(s, regexp))):
+        start = time.perf_counter()
+        for s in lines:
+            parse(s)
+        elapsed = time.perf_counter() - start
+        print('parse_line {:<20} {:>12,.0f} lines/sec'.format(name, len(lines) / elapsed))
+
+
+def time_lines_reading(read_lines, repeat):
+    """Returns (lines count, lines/sec) of reading all lines repeat times"""
+    start = time.perf_counter()
+    count = 0
+    for _ in range(repeat):
+        for _ in read_lines():
+            count += 1
+    return count, count / (time.perf_counter() - start)
+
+
+def bench_gzip_readers(lines):
+    """Prints lines/sec of reading gz fixtures from tests/log_gz and synthetic gz log
+    by plain gzip.open iteration and by LogReader"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        synthetic_log = os.path.join(tmp_dir, 'nginx-access-ui.log-20190103.gz')
+        with gzip.open(synthetic_log, 'wb') as f:
+            f.writelines(lines)
+        files = [(name, 2000) for name in sorted(glob.glob('./tests/log_gz/*.gz'))] + [(synthetic_log, 1)]
+        tool = la.find_gzip_tool()
+        print('external gz decompressor: {}'.format(' '.join(tool) if tool else 'not found'))
+        for file_name, repeat in files:
+            print(os.path.basename(file_name) + (' (x{})'.format(repeat) if repeat > 1 else ''))
+            readers = [('gzip.open lines', lambda: la.open_log_file(file_name))]
+            readers += [('LogReader ' + reader, lambda reader=reader: la.LogReader(file_name, reader))
+                        for reader in la.GZIP_READERS]
+            for name, read_lines in readers:
+                count, speed = time_lines_reading(read_lines, repeat)
+                print('  {:<20} {:>12,.0f} lines/sec ({} lines)'.format(name, speed, count))
+
+
+def bench_plain_readers(lines, urls, repeat=3):
+    """Prints lines/sec (best of repeat) of parsing synthetic plain log: lines by LogReader and parse_line
+    and in place in memory-mapped file by parse_mapped_file"""
+    regexp = la.compile_log_format(la.LOG_FORMAT)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_file = os.path.join(tmp_dir, 'nginx-access-ui.log-20190103')
+        generate_log(log_file, lines, urls, 0.01)
+        readers = (('LogReader + parse_line', lambda: (la.parse_line(s, regexp) for s in la.LogReader(log_file))),
+                   ('parse_mapped_file', lambda: la.parse_mapped_file(log_file, regexp)))
+        for name, parse in readers:
+            best = min(time_lines_reading(parse, 1)[1] for _ in range(repeat))
+            print('plain {:<24} {:>12,.0f} lines/sec ({:,} urls)'.format(name, best, urls))
+
+
+def bench_aggregation(count, urls_count=5000):
+    """Prints time of aggregation phase (aggregate and make statistic) of python and numpy backends"""
+    pairs = [('/api/v2/banner/%d' % (i * 7919 % urls_count), (i * 104729 % 3000) / 1000) for i in range(count)]
+    backends = [('python exact', lambda: la.add_to_aggregate({}, pairs, la.ExactStat))]
+    if la.np is not None:
+        backends.append(('numpy columnar', lambda: la.aggregate_columnar(pairs)))
+    else:
+        print('numpy is not installed, numpy backend is skipped')
+    for name, aggregate in backends:
+        start = time.perf_counter()
+        la.make_statistic(aggregate())
+        elapsed = time.perf_counter() - start
+        print('aggregation {:<20} {:>8.3f} sec ({:,} requests, {:,} urls)'.format(name, elapsed, count, urls_count))
+
+
+class LegacyExactStat(la.ExactStat):
+    """ExactStat as it was before compact records: request times in list of float objects"""
+
+    def __init__(self):
+        super().__init__()
+        self.times = []
+
+
+def bench_memory(count, urls_count):
+    """Prints peak memory (traced by tracemalloc) and time of aggregation and statistic of count requests
+    with urls_count distinct urls: legacy lists of floats and dict rows vs arrays and StatRow records"""
+    def requests():
+        for i in range(count):
+            yield '/api/v2/banner/%d' % (i * 7919 % urls_count), (i * 104729 % 3000) / 1000
+
+    layouts = (('lists + dict rows', lambda: [dict(row) for row in la.iter_statistic(
+                   la.add_to_aggregate({}, requests(), LegacyExactStat))]),
+               ('arrays + StatRow', lambda: la.make_statistic(la.add_to_aggregate({}, requests(), la.ExactStat))))
+    for name, aggregate in layouts:
+        tracemalloc.start()
+        start = time.perf_counter()
+        rows = aggregate()
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del rows
+        print('memory {:<20} peak {:>8.1f} Mb, rows {:>8.1f} Mb, {:>7.3f} sec ({:,} requests, {:,} urls)'.format(
+            name, peak / 2 ** 20, current / 2 ** 20, elapsed, count, urls_count))
+
+
+SYNTHETIC_LINE = ('{ip} -  - [29/Jun/2017:03:50:22 +0300] "{method} {url} HTTP/1.1" 200 927 "-" '
+                  '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" '
+                  '"1498697422-2190034393-4708-9752759" "dc7161be3" {time:.3f}\n')
+
+
+def generate_log(file_name, lines, urls=1000, bad_ratio=0.0, seed=1):
+    """Writes synthetic nginx log (gz if file_name ends with .gz) of lines with urls distinct urls
+    and bad_ratio share of lines that couldn't be parsed. Url popularity and request times are skewed"""
+    rnd = random.Random(seed)
+    url_names = ['/api/v2/banner/{}'.format(rnd.randrange(10 ** 8)) for _ in range(urls)]
+    f = gzip.open(file_name, 'wb') if file_name.endswith('.gz') else open(file_name, 'wb')
+    with f:
+        for _ in range(lines):
+            if rnd.random() < bad_ratio:
+                f.write(b'bad line\n')
+                continue
+            f.write(SYNTHETIC_LINE.format(ip='1.196.116.32', method=rnd.choice(('GET', 'POST')),
+                                          url=url_names[int(urls * rnd.random() ** 3)],
+                                          time=rnd.expovariate(5)).encode())
+
+
+def generate_log_dir(log_dir, files, args):
+    """Creates log folder with files rotated empty logs and the latest synthetic one. Returns path of the latest"""
+    date = datetime(2019, 1, 1)
+    for i in range(files):
+        open(os.path.join(log_dir, 'nginx-access-ui.log-' + (date + timedelta(days=i)).strftime('%Y%m%d')), 'w').close()
+    latest = os.path.join(log_dir, 'nginx-access-ui.log-' + (date + timedelta(days=files)).strftime('%Y%m%d') +
+                          ('.gz' if args.gz else ''))
+    generate_log(latest, args.lines, args.urls, args.bad_ratio)
+    return latest
+
+
+def peak_rss_mb():
+    """Returns peak resident set size of the process, Mb"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Phase:
+    """Context manager timing a phase of pipeline benchmark and profiling it if profiler is given"""
+
+    def __init__(self, name, profiler=None, lines=None):
+        self.name = name
+        self.profiler = profiler
+        self.lines = lines
+
+    def __enter__(self):
+        if self.profiler:
+            self.profiler.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        if self.profiler:
+            self.profiler.disable()
+        speed = '{:>12,.0f} lines/sec'.format(self.lines / elapsed) if self.lines else ' ' * 22
+        print('{:<24} {:>8.3f} sec {}   peak RSS {:>8.1f} Mb'.format(self.name, elapsed, speed, peak_rss_mb()))
+
+
+def bench_pipeline(args):
+    """Generates synthetic log folder and times phases of log_analyzer pipeline separately"""
+    profiler = cProfile.Profile() if args.profile else None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_dir = os.path.join(tmp_dir, 'log')
+        os.mkdir(log_dir)
+        start = time.perf_counter()
+        latest = generate_log_dir(log_dir, args.files, args)
+        print('synthetic log: {:,} lines, {:,} urls, {:.0%} bad lines, {} Mb{} (generated in {:.1f} sec)'.format(
+            args.lines, args.urls, args.bad_ratio, os.path.getsize(latest) // 2 ** 20, ', gz' if args.gz else '',
+            time.perf_counter() - start))
+
+        with Phase('get_latest_logfile_info', profiler):
+            file_info = la.get_latest_logfile_info(log_dir)
+        with Phase('parse_next_line', profiler, args.lines):
+            for _ in la.parse_next_line(file_info.path, 100, gzip_reader=args.gzip_reader):
+                pass
+        with Phase('analyse_log_file', profiler, args.lines):
+            data = la.analyse_log_file(file_info.path, 100, workers=args.workers, aggregation=args.aggregation,
+                                       gzip_reader=args.gzip_reader, backend=args.backend)
+        with Phase('generate_report', profiler):
+            la.generate_report(data, './template/report.html', os.path.join(tmp_dir, 'report.html'), args.report_size)
+
+    if profiler:
+        profiler.dump_stats(args.profile)
+        print('cProfile output was dumped to {}, top functions by cumulative time:'.format(args.profile))
+        pstats.Stats(args.profile).sort_stats('cumulative').print_stats(20)
+
+
+def bench_micro(args):
+    """Runs micro benchmarks of line parser, gz readers and aggregation backends"""
+    sample_lines = load_sample_lines(args.lines)
+    bench_parse_line(sample_lines)
+    bench_plain_readers(args.lines, args.urls)
+    bench_gzip_readers(sample_lines * 5)
+    bench_aggregation(args.lines * 5)
+    bench_memory(args.lines * 5, args.urls * 10)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="log_analyzer benchmarks")
+    parser.add_argument('--suite', choices=('pipeline', 'micro'), default='pipeline',
+                        help='pipeline - phases of log analysis on synthetic log (default), '
+                             'micro - line parsers, gz readers and aggregation backends')
+    parser.add_argument('--lines', type=int, default=200000, help='number of log lines (default is 200000)')
+    parser.add_argument('--urls', type=int, default=10000, help='number of distinct urls (default is 10000)')
+    parser.add_argument('--bad-ratio', type=float, default=0.01,
+                        help='share of lines that could not be parsed (default is 0.01)')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='number of rotated log files in log folder (default is 1000)')
+    parser.add_argument('--gz', action='store_true', help='generate gz log')
+    parser.add_argument('--workers', type=int, default=1, help='WORKERS of analysis (default is 1)')
+    parser.add_argument('--aggregation', choices=tuple(la.AGGREGATION_ENGINES), default='exact',
+                        help='AGGREGATION of analysis (default is exact)')
+    parser.add_argument('--backend', choices=la.AGGREGATION_BACKENDS, default='python',
+                        help='AGGREGATION_BACKEND of analysis (default is python)')
+    parser.add_argument('--gzip-reader', choices=la.GZIP_READERS, default='thread',
+                        help='GZIP_READER of analysis (default is thread)')
+    parser.add_argument('--report-size', type=int, default=1000, help='REPORT_SIZE (default is 1000)')
+    parser.add_argument('--profile', metavar='FILE', default=None,
+                        help='profile pipeline phases with cProfile and dump stats to FILE')
+    args = parser.parse_args()
+    if args.suite == 'pipeline':
+        bench_pipeline(args)
+    else:
+        bench_micro(args)
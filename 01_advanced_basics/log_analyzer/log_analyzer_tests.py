@@ -1,11 +1,17 @@
 import unittest
+import array
+import gzip
 import sys
+import csv
 import json
 import os
+import shutil
 import log_analyzer as la
 from os.path import join, exists
 import time
+import tempfile
 import webbrowser
+from datetime import datetime
 
 
 class LoadConfigTests(unittest.TestCase):
@@ -72,6 +78,51 @@ class FindLatestLogTests(unittest.TestCase):
         self.assertEqual(join('./tests/log_plain', 'nginx-access-ui.log-20190103'), file_info.path)
         self.assertEqual('20190103', file_info.date.strftime('%Y%m%d'))
 
+    def test_latest_with_index(self):
+        """Test index gives the same latest file and rescans folder only when folder is modified"""
+        for log_dir in ('./tests/log_gz', './tests/log_plain', './tests/log_no_file'):
+            with tempfile.TemporaryDirectory() as report_dir:
+                index = la.LogIndex(la.get_log_index_filename(report_dir), log_dir)
+                self.assertEqual(la.get_latest_logfile_info(log_dir, index), la.get_latest_logfile_info(log_dir))
+
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            for name in ('nginx-access-ui.log-20190103', 'nginx-access-ui.log-20191301.gz'):
+                open(join(log_dir, name), 'w').close()
+            os.utime(log_dir, (time.time() - 60, time.time() - 60))
+            index_filename = la.get_log_index_filename(report_dir)
+            index = la.LogIndex(index_filename, log_dir)
+            self.assertEqual(index.files, {})
+            self.assertEqual('20190103', la.get_latest_logfile_info(log_dir, index).date.strftime('%Y%m%d'))
+            index.save()
+
+            index = la.LogIndex.load(index_filename, log_dir)
+            self.assertEqual(list(index.files), ['nginx-access-ui.log-20190103'])
+            # folder is not modified, so it is not rescanned and indexed entries are used
+            index.files['nginx-access-ui.log-20190104'] = ['20190104', 0, 0, False]
+            self.assertEqual('20190104', la.get_latest_logfile_info(log_dir, index).date.strftime('%Y%m%d'))
+
+            open(join(log_dir, 'nginx-access-ui.log-20190105.gz'), 'w').close()
+            self.assertEqual(join(log_dir, 'nginx-access-ui.log-20190105.gz'),
+                             la.get_latest_logfile_info(log_dir, index).path)
+
+    def test_index_report_status(self):
+        """Test log file is reported until it is changed"""
+        with tempfile.TemporaryDirectory() as log_dir:
+            file_name = join(log_dir, 'nginx-access-ui.log-20190103')
+            with open(file_name, 'w') as f:
+                f.write('line\n')
+            index = la.LogIndex(la.get_log_index_filename(log_dir), log_dir)
+            index.update()
+            self.assertFalse(index.is_reported(file_name))
+            index.set_reported(file_name)
+            index.save()
+            index = la.LogIndex.load(la.get_log_index_filename(log_dir), log_dir)
+            self.assertTrue(index.is_reported(file_name))
+            with open(file_name, 'a') as f:
+                f.write('line\n')
+            self.assertTrue(index.is_changed(file_name))
+            self.assertFalse(index.is_reported(file_name))
+
 
 class AnalyzeTest(unittest.TestCase):
     """Tests analyze and report"""
@@ -105,6 +156,49 @@ class AnalyzeTest(unittest.TestCase):
         with self.assertRaises(UserWarning):
             la.analyse_log_file(file_info.path, 40)
 
+    def test_parallel_analyze_plain(self):
+        """Check parallel analyze of plain log file gives the same result as single process"""
+        chunk_min_size = la.CHUNK_MIN_SIZE
+        la.CHUNK_MIN_SIZE = 1000
+        try:
+            log_file = './tests/log_plain/nginx-access-ui.log-20190103'
+            self.assertGreater(len(la.split_file_to_chunks(log_file, 8)), 1, msg='File is split to several chunks')
+            self.assertEqual(la.analyse_log_file(log_file), la.analyse_log_file(log_file, workers=2))
+        finally:
+            la.CHUNK_MIN_SIZE = chunk_min_size
+
+    def test_parallel_analyze_gz(self):
+        """Check parallel analyze of gz log file gives the same result as single process"""
+        gz_block_size = la.GZ_BLOCK_SIZE
+        la.GZ_BLOCK_SIZE = 300
+        try:
+            log_file = './tests/log_gz/nginx-access-ui.log-20190105.gz'
+            self.assertEqual(la.analyse_log_file(log_file), la.analyse_log_file(log_file, workers=2))
+        finally:
+            la.GZ_BLOCK_SIZE = gz_block_size
+
+    def test_split_file_to_chunks(self):
+        """Check chunks cover the whole file and are aligned to line ends"""
+        chunk_min_size = la.CHUNK_MIN_SIZE
+        la.CHUNK_MIN_SIZE = 1000
+        try:
+            log_file = './tests/log_plain/nginx-access-ui.log-20190103'
+            chunks = la.split_file_to_chunks(log_file, 4)
+            self.assertEqual(chunks[0][0], 0)
+            self.assertEqual(chunks[-1][1], os.path.getsize(log_file))
+            with open(log_file, 'rb') as f:
+                for start, end in chunks:
+                    f.seek(start)
+                    self.assertTrue(f.read(end - start).endswith(b'\n') or end == os.path.getsize(log_file))
+        finally:
+            la.CHUNK_MIN_SIZE = chunk_min_size
+
+    def test_file_format_error_parallel(self):
+        """Test error generated in parallel mode when most of lines couldn't be parsed"""
+        file_info = la.get_latest_logfile_info('./tests/log_bad_format')
+        with self.assertRaises(UserWarning):
+            la.analyse_log_file(file_info.path, 40, workers=2)
+
     def test_integral(self):
         """Ultimate integral test. It may takes several minutes. Check result in browser (10 rows)."""
 
@@ -141,9 +235,607 @@ class AnalyzeTest(unittest.TestCase):
         webbrowser.open(output_url, new=2)
 
 
+class ErrorCheckTest(unittest.TestCase):
+    """Early error threshold check tests (ErrorThresholdCheck)"""
+
+    @classmethod
+    def setUpClass(cls):
+        with open('./tests/log_plain/nginx-access-ui.log-20190103', 'rb') as f:
+            cls.good_line = f.readline()
+
+    def write_log(self, file_name, lines_count, bad_every):
+        """Writes log where every bad_every line is bad"""
+        with open(file_name, 'wb') as f:
+            for i in range(lines_count):
+                f.write(b'bad line\n' if i % bad_every == 0 else self.good_line)
+
+    def test_lower_bound(self):
+        """Check confidence interval of bad lines share"""
+        check = la.ErrorThresholdCheck(50, 1000, 0.999)
+        self.assertTrue(0.45 < check.lower_bound(500, 500) < 0.5)
+        self.assertTrue(check.lower_bound(5000, 5000) > check.lower_bound(500, 500))
+        check(500, 500)
+        with self.assertRaises(UserWarning):
+            check(0, 1000)
+        check(0, 999)
+
+    def test_threshold_boundary(self):
+        """Check early check doesn't stop files accepted by the final check (floored percent of bad lines)"""
+        la.check_error_threshold(494000, 506000, 50)
+        la.ErrorThresholdCheck(50)(494000, 506000)
+        la.check_error_threshold(999744, 256, 0)
+        la.ErrorThresholdCheck(0)(999744, 256)
+        with self.assertRaises(UserWarning):
+            la.ErrorThresholdCheck(50)(470000, 530000)
+
+    def test_early_abort(self):
+        """Check parsing of bad file stops after first check and good enough file is parsed to the end"""
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_file = join(log_dir, 'nginx-access-ui.log-20190103')
+            self.write_log(log_file, 100000, 1)
+            with self.assertRaisesRegex(UserWarning, '2048 of first 2048 lines'):
+                list(la.parse_next_line(log_file, 50, error_check=(2000, 0.999)))
+            with self.assertRaisesRegex(UserWarning, 'of first'):
+                la.aggregate_log_file(log_file, workers=2, error_check=(2000, 0.999))
+            with self.assertRaisesRegex(UserWarning, '100% lines'):
+                list(la.parse_next_line(log_file, 50, error_check=(2000, None)))
+
+            self.write_log(log_file, 20000, 3)
+            self.assertEqual(len(list(la.parse_next_line(log_file, 40, error_check=(1000, 0.999)))), 13333)
+            with self.assertRaisesRegex(UserWarning, 'of first'):
+                list(la.parse_next_line(log_file, 20, error_check=(1000, 0.999)))
+
+
+class AggregationTest(unittest.TestCase):
+    """Per-url statistic engines tests (ExactStat, HistogramStat)"""
+
+    times = [(i * 7919 % 1000 + 1) / 1000 for i in range(1000)] + [0.0, 12.5]
+
+    def test_exact_quantile(self):
+        """Check exact quantiles are interpolated between closest ranks"""
+        stat = la.ExactStat()
+        for t in (0.1, 0.2, 0.3, 0.4, 0.5):
+            stat.add(t)
+        self.assertAlmostEqual(stat.median(), 0.3)
+        self.assertAlmostEqual(stat.quantile(0.9), 0.46)
+        self.assertAlmostEqual(stat.quantile(1), 0.5)
+
+    def test_histogram_error_bound(self):
+        """Check histogram quantiles are within stated relative error from exact ones"""
+        exact = la.ExactStat()
+        hist = la.HistogramStat()
+        for t in self.times:
+            exact.add(t)
+            hist.add(t)
+        self.assertEqual(hist.count, exact.count)
+        self.assertAlmostEqual(hist.time_sum, exact.time_sum)
+        self.assertEqual(hist.time_max, exact.time_max)
+        for q in (0.5, 0.9, 0.95, 0.99):
+            rank_value = sorted(self.times)[int(q * (len(self.times) - 1))]
+            self.assertLessEqual(abs(hist.quantile(q) - rank_value), rank_value * la.HISTOGRAM_ACCURACY + 1e-12)
+
+    def test_histogram_merge(self):
+        """Check merged histogram is the same as built from all times"""
+        whole = la.HistogramStat()
+        first = la.HistogramStat()
+        second = la.HistogramStat()
+        for i, t in enumerate(self.times):
+            whole.add(t)
+            (first if i % 2 else second).add(t)
+        first.merge(second)
+        self.assertEqual(first.buckets, whole.buckets)
+        self.assertEqual(first.count, whole.count)
+        self.assertEqual(first.median(), whole.median())
+
+    def test_analyse_histogram(self):
+        """Check histogram engine gives the same counters as exact one"""
+        log_file = './tests/log_plain/nginx-access-ui.log-20190103'
+        exact = {d['url']: d for d in la.analyse_log_file(log_file)}
+        hist = {d['url']: d for d in la.analyse_log_file(log_file, aggregation='histogram')}
+        self.assertEqual(exact.keys(), hist.keys())
+        for url, d in hist.items():
+            self.assertEqual(d['count'], exact[url]['count'])
+            self.assertAlmostEqual(d['time_sum'], exact[url]['time_sum'])
+            self.assertIn('time_p99', d)
+
+    def test_unknown_engine(self):
+        """Check error on unknown aggregation engine"""
+        with self.assertRaises(ValueError):
+            la.analyse_log_file('./tests/log_plain/nginx-access-ui.log-20190103', aggregation='unknown')
+
+
+class LogFormatTest(unittest.TestCase):
+    """Line parser generated from nginx log_format tests (compile_log_format, parse_line methods)"""
+
+    line = (b'1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/16852664 HTTP/1.1" 200 19415 '
+            b'"-" "Slotovod" "-" "1498697422-2118016444-4708-9752769" "712e90144abee9" 0.199\n')
+
+    def test_default_format(self):
+        """Check url and request time are parsed with default log format"""
+        self.assertEqual(la.parse_line(self.line), ('/api/v2/banner/16852664', 0.199))
+        self.assertEqual(la.parse_line(b'\xef\xbb\xbf' + self.line), ('/api/v2/banner/16852664', 0.199))
+
+    def test_wrong_lines(self):
+        """Check wrong lines are not parsed"""
+        self.assertIsNone(la.parse_line(self.line.replace(b'GET', b'SOMETHING WRONG')))
+        self.assertIsNone(la.parse_line(self.line.replace(b' 0.199', b'')))
+        self.assertIsNone(la.parse_line(b'bad string\n'))
+
+    def test_custom_format(self):
+        """Check parser for custom log format"""
+        regexp = la.compile_log_format('$remote_addr [$time_local] $request_uri $status $request_time')
+        self.assertEqual(la.parse_line(b'1.1.1.1 [29/Jun/2017:03:50:22 +0300] /api/1 200 1.5\n', regexp),
+                         ('/api/1', 1.5))
+
+    def test_format_without_fields(self):
+        """Check error on log format without url or request time"""
+        with self.assertRaises(ValueError):
+            la.compile_log_format('$remote_addr "$request" $status')
+        with self.assertRaises(ValueError):
+            la.compile_log_format('$remote_addr $request_time')
+
+
+class StateTest(unittest.TestCase):
+    """Stored aggregate states and rollups tests"""
+
+    log_file = './tests/log_plain/nginx-access-ui.log-20190103'
+
+    def test_state_roundtrip(self):
+        """Check statistic from stored state is the same as from log file"""
+        for aggregation in la.AGGREGATION_ENGINES:
+            url_dict = la.aggregate_log_file(self.log_file, aggregation=aggregation)
+            with tempfile.TemporaryDirectory() as report_dir:
+                state_filename = la.get_state_filename(report_dir, datetime(2019, 1, 3))
+                la.save_state(state_filename, url_dict, aggregation)
+                loaded_aggregation, loaded_dict = la.load_state(state_filename)
+            self.assertEqual(loaded_aggregation, aggregation)
+            self.assertEqual(la.make_statistic(loaded_dict), la.make_statistic(url_dict))
+
+    def test_state_foreign_byteorder(self):
+        """Check exact state written on platform with other byte order is read"""
+        times = array.array('d', [0.1, 0.25, 3.0])
+        times.byteswap()
+        header = {'aggregation': 'exact', 'byteorder': 'big' if sys.byteorder == 'little' else 'little',
+                  'urls': [['/a', len(times.tobytes())]]}
+        with tempfile.TemporaryDirectory() as report_dir:
+            state_filename = la.get_state_filename(report_dir, datetime(2019, 1, 3))
+            os.makedirs(os.path.dirname(state_filename))
+            with gzip.open(state_filename, 'wb') as f:
+                f.write(json.dumps(header).encode() + b'\n' + times.tobytes())
+            aggregation, url_dict = la.load_state(state_filename)
+        self.assertEqual(aggregation, 'exact')
+        self.assertEqual(url_dict['/a'].times.tolist(), [0.1, 0.25, 3.0])
+
+    def test_rollup_period(self):
+        """Check calendar week and month of rollup"""
+        self.assertEqual(la.get_rollup_period(datetime(2019, 1, 3), 'week'),
+                         (datetime(2018, 12, 31), datetime(2019, 1, 6), '2019-W01'))
+        self.assertEqual(la.get_rollup_period(datetime(2019, 2, 10), 'month'),
+                         (datetime(2019, 2, 1), datetime(2019, 2, 28), '2019-02'))
+
+    def test_rollup_states(self):
+        """Check rollup merges states of the latest period only"""
+        url_dict = la.aggregate_log_file(self.log_file, aggregation='histogram')
+        with tempfile.TemporaryDirectory() as report_dir:
+            for date in (datetime(2019, 1, 2), datetime(2019, 1, 3), datetime(2018, 12, 1)):
+                la.save_state(la.get_state_filename(report_dir, date), url_dict, 'histogram')
+            label, rollup_dict = la.rollup_states(report_dir, 'month', 'histogram')
+            self.assertEqual(label, '2019-01')
+            self.assertEqual(rollup_dict.keys(), url_dict.keys())
+            for url, stat in rollup_dict.items():
+                self.assertEqual(stat.count, 2 * url_dict[url].count)
+            label, rollup_dict = la.rollup_states(report_dir, 'month', 'exact')
+            self.assertEqual(rollup_dict, {}, msg='States of other aggregation are skipped')
+
+
+class FollowTest(unittest.TestCase):
+    """Follow mode tests (LogFollower, follow_log_file)"""
+
+    def test_read_appended_lines(self):
+        """Check only complete appended lines are returned"""
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_file = join(log_dir, 'nginx-access-ui.log')
+            follower = la.LogFollower(log_file)
+            self.assertEqual(follower.read_lines(), [], msg='No file yet')
+            with open(log_file, 'wb') as f:
+                f.write(b'line1\nline')
+            self.assertEqual(follower.read_lines(), [b'line1'])
+            with open(log_file, 'ab') as f:
+                f.write(b'2\n')
+            self.assertEqual(follower.read_lines(), [b'line2'])
+            self.assertFalse(follower.is_rotated())
+            follower.close()
+
+    def test_read_by_blocks(self):
+        """Check file is read by blocks of buffer_size bytes"""
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_file = join(log_dir, 'nginx-access-ui.log')
+            with open(log_file, 'wb') as f:
+                f.write(b'line1\nline2\nline3\n')
+            follower = la.LogFollower(log_file, buffer_size=8)
+            self.assertEqual(follower.read_lines(), [b'line1'])
+            self.assertEqual(follower.read_lines(), [b'line2'])
+            self.assertEqual(follower.read_lines(), [b'line3'])
+            self.assertEqual(follower.read_lines(), [])
+            follower.close()
+
+    def test_rotation(self):
+        """Check rotated file is detected, read to the end and new file is read from the beginning"""
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_file = join(log_dir, 'nginx-access-ui.log')
+            with open(log_file, 'wb') as f:
+                f.write(b'old line\n')
+            follower = la.LogFollower(log_file)
+            self.assertEqual(follower.read_lines(), [b'old line'])
+            with open(log_file, 'ab') as f:
+                f.write(b'last old line\n')
+            os.rename(log_file, log_file + '-20190103')
+            with open(log_file, 'wb') as f:
+                f.write(b'new line\n')
+            self.assertTrue(follower.is_rotated())
+            self.assertEqual(follower.read_lines(), [b'last old line'], msg='Rotated file is read to the end')
+            follower.close()
+            self.assertEqual(follower.read_lines(), [b'new line'])
+            follower.close()
+
+    def test_follow_report(self):
+        """Check live report is generated from followed log file"""
+        with tempfile.TemporaryDirectory() as report_dir:
+            cfg = dict(la.config, LOG_DIR='./tests/log_generate_report', REPORT_DIR=report_dir,
+                       FOLLOW_FILENAME='nginx-access-ui.log-20190103', FOLLOW_INTERVAL=0, URL_MAX_COUNT=1000)
+            la.follow_log_file(cfg, max_reports=1)
+            with open(join(report_dir, 'report-live.html'), encoding='utf-8') as f:
+                self.assertIn('5_double_url', f.read())
+            with self.assertRaises(ValueError, msg='Number of urls should be limited'):
+                la.follow_log_file(dict(cfg, URL_MAX_COUNT=None), max_reports=1)
+
+
+class BackfillTest(unittest.TestCase):
+    """Batch mode tests (backfill_reports)"""
+
+    def test_backfill(self):
+        """Check reports are generated for every unreported file, bad file doesn't stop the others"""
+        plain_log = './tests/log_plain/nginx-access-ui.log-20190103'
+        bad_log = './tests/log_bad_format/nginx-access-ui.log-20181201'
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            for name, source in (('nginx-access-ui.log-20190101', plain_log),
+                                 ('nginx-access-ui.log-20190102.gz', './tests/log_gz/nginx-access-ui.log-20190105.gz'),
+                                 ('nginx-access-ui.log-20190103', bad_log),
+                                 ('nginx-access-ui.log-20190104', plain_log)):
+                shutil.copy(source, join(log_dir, name))
+            with open(join(report_dir, 'report-2019-01-04.html'), 'w') as f:
+                f.write('done')
+            for workers in (1, 2):
+                for report in ('report-2019-01-01.html', 'report-2019-01-02.html'):
+                    if exists(join(report_dir, report)):
+                        os.remove(join(report_dir, report))
+                cfg = dict(la.config, LOG_DIR=log_dir, REPORT_DIR=report_dir, WORKERS=workers)
+                reported, failed = la.backfill_reports(cfg)
+                self.assertEqual(sorted(reported), [join(log_dir, 'nginx-access-ui.log-20190101'),
+                                                    join(log_dir, 'nginx-access-ui.log-20190102.gz')])
+                self.assertEqual(failed, [join(log_dir, 'nginx-access-ui.log-20190103')])
+                self.assertEqual(sorted(os.listdir(report_dir)),
+                                 ['report-2019-01-01.html', 'report-2019-01-02.html', 'report-2019-01-04.html'])
+            with open(join(report_dir, 'report-2019-01-04.html')) as f:
+                self.assertEqual(f.read(), 'done')
+
+    def test_changed_log_with_stored_state(self):
+        """Check report of log file changed after report is rebuilt from the file, not from its stored state"""
+        plain_log = './tests/log_plain/nginx-access-ui.log-20190103'
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            log_file = join(log_dir, 'nginx-access-ui.log-20190103')
+            shutil.copy(plain_log, log_file)
+            cfg = dict(la.config, LOG_DIR=log_dir, REPORT_DIR=report_dir, WORKERS=1, INCREMENTAL=True,
+                       LOG_INDEX=True, REPORT_FORMATS=['jsonl'], REPORT_SIZE=1000)
+            report_file = join(report_dir, 'report-2019-01-03.jsonl')
+            for requests_count in (60, 120):
+                index = la.LogIndex.load(la.get_log_index_filename(report_dir), log_dir)
+                reported, failed = la.backfill_reports(cfg, index)
+                self.assertEqual(reported, [log_file])
+                with open(report_file, encoding='utf-8') as f:
+                    self.assertEqual(sum(json.loads(line)['count'] for line in f), requests_count)
+                _, url_dict = la.load_state(la.get_state_filename(report_dir, datetime(2019, 1, 3)))
+                self.assertEqual(sum(stat.count for stat in url_dict.values()), requests_count)
+                with open(plain_log, 'rb') as source, open(log_file, 'ab') as f:
+                    f.write(b'\n' + source.read())
+
+
+class ReportTest(unittest.TestCase):
+    """Report generation tests (generate_report method)"""
+
+    log_file = './tests/log_plain/nginx-access-ui.log-20190103'
+
+    def test_select_top(self):
+        """Check top rows selection is the same as full sort"""
+        data = la.analyse_log_file(self.log_file)
+        self.assertEqual(la.select_top(iter(data), 10),
+                         sorted(data, key=lambda p: p['time_sum'], reverse=True)[:10])
+
+    def test_streamed_report(self):
+        """Check streamed report is the same as template substitution of the whole table"""
+        from string import Template
+        data = la.analyse_log_file(self.log_file)
+        top = sorted(data, key=lambda p: p['time_sum'], reverse=True)[:10]
+        with open('./template/report.html', encoding='utf-8') as f:
+            expected = Template(f.read()).safe_substitute(table_json=json.dumps([la.format_report_row(d) for d in top]))
+        with tempfile.TemporaryDirectory() as report_dir:
+            report_file = join(report_dir, 'report.html')
+            la.generate_report(iter(data), './template/report.html', report_file, 10)
+            with open(report_file, encoding='utf-8') as f:
+                self.assertEqual(f.read(), expected)
+
+    def test_report_formats(self):
+        """Check reports in jsonl, csv and columnar formats contain all rows"""
+        data = la.analyse_log_file(self.log_file)
+        expected = {field: [row[field] for row in data] for field in la.STAT_FIELDS}
+        with tempfile.TemporaryDirectory() as report_dir:
+            cfg = dict(la.config, REPORT_DIR=report_dir, REPORT_SIZE=None,
+                       REPORT_FORMATS=['html', 'jsonl', 'csv', 'columnar'])
+            la.write_reports(cfg, la.aggregate_log_file(self.log_file), la.get_report_filename(report_dir, 'test'))
+            self.assertEqual(sorted(os.listdir(report_dir)),
+                             ['report-test.csv', 'report-test.html', 'report-test.jsonl', 'report-test.lacol'])
+
+            with open(join(report_dir, 'report-test.jsonl'), encoding='utf-8') as f:
+                self.assertEqual([json.loads(line) for line in f], [dict(row) for row in data])
+            with open(join(report_dir, 'report-test.csv'), encoding='utf-8', newline='') as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual([row['url'] for row in rows], expected['url'])
+            self.assertEqual([float(row['time_p95']) for row in rows], expected['time_p95'])
+            self.assertEqual(la.read_columnar_report(join(report_dir, 'report-test.lacol')), expected)
+
+        with tempfile.TemporaryDirectory() as report_dir:
+            report_file = join(report_dir, 'report.lacol')
+            columnar_group_size = la.COLUMNAR_REPORT_GROUP_SIZE
+            la.COLUMNAR_REPORT_GROUP_SIZE = 7
+            try:
+                la.generate_report(iter(data), None, report_file, report_format='columnar')
+            finally:
+                la.COLUMNAR_REPORT_GROUP_SIZE = columnar_group_size
+            self.assertEqual(la.read_columnar_report(report_file), expected)
+
+    def test_paged_report(self):
+        """Check paged report inlines the first page and writes other pages to sidecar folder"""
+        data = la.analyse_log_file(self.log_file)
+        top = sorted(data, key=lambda p: p['time_sum'], reverse=True)[:50]
+        page_size = la.REPORT_PAGE_SIZE
+        la.REPORT_PAGE_SIZE = 20
+        try:
+            with tempfile.TemporaryDirectory() as report_dir:
+                cfg = dict(la.config, REPORT_DIR=report_dir, REPORT_SIZE=50, REPORT_FORMATS=['html_paged'])
+                for _ in range(2):
+                    la.write_reports(cfg, la.aggregate_log_file(self.log_file), join(report_dir, 'report-test.html'))
+                self.assertEqual(sorted(os.listdir(report_dir)), ['report-test-pages', 'report-test.html'])
+                self.assertEqual(sorted(os.listdir(join(report_dir, 'report-test-pages'))), ['page-1.js', 'page-2.js'])
+                with open(join(report_dir, 'report-test.html'), encoding='utf-8') as f:
+                    report = f.read()
+                self.assertIn('var pages = [{}];'.format(json.dumps([la.format_report_row(d) for d in top[:20]])),
+                              report)
+                self.assertIn('var pagesDir = "report-test-pages";', report)
+                self.assertIn('var pagesCount = 3;', report)
+                self.assertIn('var rowsCount = 50;', report)
+                self.assertIn('sorts rows of the current page only', report, msg='Page-local sort is labeled')
+                with open(join(report_dir, 'report-test-pages', 'page-2.js'), encoding='utf-8') as f:
+                    self.assertEqual(f.read(), 'reportPage(2, {});\n'.format(
+                        json.dumps([la.format_report_row(d) for d in top[40:]])))
+        finally:
+            la.REPORT_PAGE_SIZE = page_size
+
+    def test_unknown_format(self):
+        """Check error on unknown report format"""
+        with self.assertRaises(ValueError):
+            la.generate_report([], './template/report.html', 'report.xml', report_format='xml')
+
+    def test_report_formats_check(self):
+        """Check error on unknown report format and on formats written to the same file"""
+        la.check_report_formats(['html', 'jsonl', 'csv', 'columnar'])
+        la.check_report_formats(['html_paged', 'jsonl'])
+        for report_formats in (['html', 'xml'], ['html', 'html_paged'], ['jsonl', 'html_paged', 'html']):
+            with self.assertRaises(ValueError):
+                la.check_report_formats(report_formats)
+
+
+class UrlNormalizationTest(unittest.TestCase):
+    """Url normalization and cardinality limit tests"""
+
+    log_file = './tests/log_plain/nginx-access-ui.log-20190103'
+
+    def test_no_normalization(self):
+        """Check normalizer is not created when nothing is set"""
+        self.assertIsNone(la.get_url_normalizer())
+        self.assertIsNone(la.get_url_normalizer(*la.get_url_normalization(la.config)))
+
+    def test_normalizer(self):
+        """Check query string stripping, numeric segments collapsing and rules"""
+        normalize = la.get_url_normalizer(strip_query=True)
+        self.assertEqual(normalize('/api/1/list/?server_name=WIN7RB4'), '/api/1/list/')
+        normalize = la.get_url_normalizer(collapse_numbers=True)
+        self.assertEqual(normalize('/api/v2/banner/25019354'), '/api/v2/banner/{id}')
+        self.assertEqual(normalize('/api/v2/slot/4705/groups?id=1'), '/api/v2/slot/{id}/groups?id=1')
+        normalize = la.get_url_normalizer(((r'^/export/.*', '/export/*'), ), collapse_numbers=True)
+        self.assertEqual(normalize('/export/appinstall_raw/2017-06-29/'), '/export/*')
+        self.assertIs(normalize, la.get_url_normalizer(((r'^/export/.*', '/export/*'), ), collapse_numbers=True),
+                      msg='Normalizer with compiled rules is cached')
+
+    def test_max_urls(self):
+        """Check urls above limit are counted as other, in single and parallel modes"""
+        chunk_min_size = la.CHUNK_MIN_SIZE
+        la.CHUNK_MIN_SIZE = 1000
+        try:
+            data = la.analyse_log_file(self.log_file, max_urls=10)
+            parallel_data = la.analyse_log_file(self.log_file, workers=2, max_urls=10)
+        finally:
+            la.CHUNK_MIN_SIZE = chunk_min_size
+        self.assertEqual(len(data), 11)
+        self.assertEqual(data[-1]['url'], la.OTHER_URL)
+        self.assertEqual(sum(d['count'] for d in data), 60)
+        self.assertEqual(data, parallel_data, msg='Times of other urls are summed in the same order')
+
+    def test_merge_other_in_line_order(self):
+        """Check exact statistic of other urls gets request times of partial aggregates in line order"""
+        options = la.ParseOptions('exact', la.LOG_FORMAT, (), True)
+        partials = [la.aggregate_parsed_lines([('a', 0.1), ('b', 0.2), ('c', 0.3), ('b', 0.4), None], options),
+                    la.aggregate_parsed_lines([('c', 0.5), ('d', 0.6), ('c', 0.7), ('a', 0.8)], options)]
+        url_dict, good_parse, bad_parse = la.merge_aggregates(partials, max_urls=1)
+        self.assertEqual((good_parse, bad_parse), (8, 1))
+        self.assertEqual(list(url_dict), ['a', la.OTHER_URL])
+        self.assertEqual(url_dict[la.OTHER_URL].times.tolist(), [0.2, 0.3, 0.4, 0.5, 0.6, 0.7])
+
+
+class LogReaderTest(unittest.TestCase):
+    """Log input layer tests (LogReader, parse_mapped_file)"""
+
+    log_files = ('./tests/log_gz/nginx-access-ui.log-20190105.gz', './tests/log_plain/nginx-access-ui.log-20190103')
+
+    def test_lines(self):
+        """Check lines are the same as read by line iteration, for all readers and buffer sizes"""
+        for log_file in self.log_files:
+            with la.open_log_file(log_file) as f:
+                expected = [line.rstrip(b'\n') for line in f]
+            for reader in la.GZIP_READERS:
+                for buffer_size in (100, la.READ_BUFFER_SIZE):
+                    self.assertEqual([bytes(line) for line in la.LogReader(log_file, reader, buffer_size)], expected,
+                                     msg='{} {} {}'.format(log_file, reader, buffer_size))
+
+    def test_blocks(self):
+        """Check blocks are aligned to line ends and cover the whole file"""
+        for log_file in self.log_files:
+            with la.open_log_file(log_file) as f:
+                expected = f.read()
+            for reader in la.GZIP_READERS:
+                blocks = list(la.LogReader(log_file, reader, 1000).blocks())
+                self.assertGreater(len(blocks), 1)
+                self.assertTrue(all(block.endswith(b'\n') for block in blocks[:-1]))
+                self.assertEqual(b''.join(blocks), expected)
+
+    def test_stop_reading(self):
+        """Check reading could be stopped before the end of file"""
+        for reader in la.GZIP_READERS:
+            lines = iter(la.LogReader(self.log_files[0], reader, 100))
+            next(lines)
+            lines.close()
+
+    def test_unknown_reader(self):
+        """Check error on unknown gzip reader"""
+        with self.assertRaises(ValueError):
+            la.LogReader(self.log_files[0], 'unknown')
+
+    def test_mapped_file(self):
+        """Check memory-mapped parsing gives the same as parsing of lines, for whole file and byte ranges"""
+        regexp = la.compile_log_format(la.LOG_FORMAT)
+        with open(self.log_files[1], 'rb') as f:
+            lines = f.read().split(b'\n')
+        lines = lines[:3] + [b'', lines[3].replace(b'GET /', b'GET /\xff'), b'bad line'] + lines[3:]
+        chunk_min_size = la.CHUNK_MIN_SIZE
+        la.CHUNK_MIN_SIZE = 300
+        try:
+            with tempfile.TemporaryDirectory() as log_dir:
+                log_file = join(log_dir, 'nginx-access-ui.log-20190103')
+                for data in (b'\n'.join(lines), b'\n'.join(lines).rstrip(b'\n'), b''):
+                    with open(log_file, 'wb') as f:
+                        f.write(data)
+                    expected = [la.parse_line(line, regexp) for line in la.LogReader(log_file)]
+                    self.assertEqual(list(la.parse_mapped_file(log_file, regexp)), expected)
+                    self.assertEqual([parsed for start, end in la.split_file_to_chunks(log_file, 5)
+                                      for parsed in la.parse_mapped_file(log_file, regexp, start, end)], expected)
+        finally:
+            la.CHUNK_MIN_SIZE = chunk_min_size
+
+
+@unittest.skipIf(la.np is None, 'numpy is not installed')
+class ColumnarBackendTest(unittest.TestCase):
+    """Numpy aggregation backend tests (aggregate_columnar)"""
+
+    log_files = ('./tests/log_plain/nginx-access-ui.log-20190103',
+                 './tests/log_generate_report/nginx-access-ui.log-20190103')
+
+    def test_same_statistic(self):
+        """Check numpy backend gives the same statistic as python one"""
+        batch_size = la.COLUMNAR_BATCH_SIZE
+        la.COLUMNAR_BATCH_SIZE = 7
+        try:
+            for log_file in self.log_files:
+                for max_urls in (None, 5):
+                    self.assertEqual(la.analyse_log_file(log_file, backend='numpy', max_urls=max_urls),
+                                     la.analyse_log_file(log_file, max_urls=max_urls))
+        finally:
+            la.COLUMNAR_BATCH_SIZE = batch_size
+
+    def test_stat_interface(self):
+        """Check columnar stat quantiles, merge and state"""
+        url_dict = la.aggregate_columnar([('a', 0.3), ('b', 1.0), ('a', 0.1), ('a', 0.2)])
+        self.assertEqual(la.ExactStat.from_state(url_dict['a'].to_state()).times.tolist(), [0.1, 0.2, 0.3])
+        self.assertAlmostEqual(url_dict['a'].quantile(0.25), 0.15)
+        url_dict['a'].merge(url_dict['b'])
+        self.assertEqual((url_dict['a'].count, url_dict['a'].time_max, url_dict['a'].median()), (4, 1.0, 0.25))
+
+    def test_unknown_backend(self):
+        """Check error on unknown backend"""
+        with self.assertRaises(ValueError):
+            la.analyse_log_file(self.log_files[0], backend='unknown')
+
+
+class SeriesTest(unittest.TestCase):
+    """Time series tests (parse_time_local, aggregate_log_series, iter_series methods)"""
+
+    log_file = './tests/log_plain/nginx-access-ui.log-20190103'
+
+    def test_parse_time_local(self):
+        """Check cached $time_local parser gives the same timestamps as strptime"""
+        for value in ('29/Jun/2017:03:50:22 +0300', '01/Jan/2018:00:00:59 -0530', '31/Dec/2017:23:59:00 +0000'):
+            self.assertEqual(la.parse_time_local(value.encode()),
+                             int(datetime.strptime(value, '%d/%b/%Y:%H:%M:%S %z').timestamp()))
+
+    def test_series_bucket(self):
+        """Check series bucket config values"""
+        self.assertEqual([la.get_series_bucket(v) for v in (60, '1m', '5m', '1h', '30s')], [60, 60, 300, 3600, 30])
+        for value in ('0', '5d', 'm', None):
+            with self.assertRaises(ValueError):
+                la.get_series_bucket(value)
+
+    def test_series(self):
+        """Check series are aligned to buckets and sum up to per-url statistic"""
+        url_dict, series = la.aggregate_log_series(self.log_file, 300, max_urls=100)
+        self.assertEqual(la.make_statistic(url_dict), la.analyse_log_file(self.log_file))
+        self.assertEqual(sum(stat.count for stat in series[la.SERIES_ALL].values()),
+                         sum(stat.count for stat in url_dict.values()))
+        for url, stat in url_dict.items():
+            self.assertEqual(sum(s.count for s in series[url].values()), stat.count)
+            self.assertTrue(all(bucket % 300 == 0 for bucket in series[url]))
+        rows = list(la.iter_series(url_dict, series, 2))
+        self.assertEqual(len({row['url'] for row in rows}), 3)
+        self.assertEqual(rows[0]['url'], la.SERIES_ALL)
+        self.assertTrue(rows[0]['time'].endswith('+00:00') and 'time_p99' in rows[0])
+
+    def test_series_max_urls(self):
+        """Check series of urls above limit are kept as other and limit is required"""
+        url_dict, series = la.aggregate_log_series(self.log_file, 300, max_urls=10)
+        self.assertEqual(la.make_statistic(url_dict), la.analyse_log_file(self.log_file, max_urls=10))
+        self.assertEqual(series.keys() - url_dict.keys(), {la.SERIES_ALL})
+        self.assertEqual(sum(s.count for s in series[la.OTHER_URL].values()), url_dict[la.OTHER_URL].count)
+        with self.assertRaises(ValueError):
+            la.aggregate_log_series(self.log_file, 300)
+
+    def test_format_without_time(self):
+        """Check error on log format without $time_local"""
+        with self.assertRaises(ValueError):
+            la.aggregate_log_series(self.log_file, 60, log_format='$remote_addr $request_uri $request_time',
+                                    max_urls=100)
+
+
 if __name__ == '__main__':
     la_TestSuite = unittest.TestSuite()
     la_TestSuite.addTest(unittest.makeSuite(LoadConfigTests))
     la_TestSuite.addTest(unittest.makeSuite(FindLatestLogTests))
     la_TestSuite.addTest(unittest.makeSuite(AnalyzeTest))
+    la_TestSuite.addTest(unittest.makeSuite(ErrorCheckTest))
+    la_TestSuite.addTest(unittest.makeSuite(AggregationTest))
+    la_TestSuite.addTest(unittest.makeSuite(LogFormatTest))
+    la_TestSuite.addTest(unittest.makeSuite(StateTest))
+    la_TestSuite.addTest(unittest.makeSuite(FollowTest))
+    la_TestSuite.addTest(unittest.makeSuite(BackfillTest))
+    la_TestSuite.addTest(unittest.makeSuite(ReportTest))
+    la_TestSuite.addTest(unittest.makeSuite(UrlNormalizationTest))
+    la_TestSuite.addTest(unittest.makeSuite(LogReaderTest))
+    la_TestSuite.addTest(unittest.makeSuite(ColumnarBackendTest))
+    la_TestSuite.addTest(unittest.makeSuite(SeriesTest))
     unittest.TextTestRunner(verbosity=3).run(la_TestSuite)
@@ -27,8 +27,35 @@
 # Можно свободно определять свои функции и т.п.
 # -----------------
 
+import array
+import bisect
 import itertools
-from functools import reduce
+import math
+import mmap
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import tempfile
+from collections import namedtuple
+from functools import reduce, lru_cache
+from statistics import NormalDist
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+RANKS = '23456789TJQKA'
+SUITS = 'CDHS'
+DECK = [rank + suit for rank in RANKS for suit in SUITS]
+JOKERS = ['?B', '?R']
+RANK_VALUES = {rank: value for value, rank in enumerate(RANKS, 2)}
+# Номер карты - ее индекс в DECK: 4 * (ранг - 2) + номер масти в SUITS
+CARD_INDEX = {card: i for i, card in enumerate(DECK)}
+# Биты карт (и джокеров) в битовой маске "руки" (см. card_mask)
+CARD_BITS = {card: 1 << i for i, card in enumerate(DECK + JOKERS)}
 
 
 def hand_rank(hand):
@@ -57,13 +84,12 @@ def hand_rank(hand):
 def card_ranks(hand):
     """Возвращает список рангов (его числовой эквивалент),
     отсортированный от большего к меньшему"""
-    translate_map = {value: index for index, value in enumerate('0123456789TJQKA')}
-    return sorted([translate_map[card[0]] for card in hand], reverse=True)
+    return sorted([RANK_VALUES[card[0]] for card in hand], reverse=True)
 
 
 def flush(hand):
     """Возвращает True, если все карты одной масти"""
-    return reduce(lambda x, y: x if x[1] == y[1] else '__', hand) == hand[0]
+    return len({card[1] for card in hand}) == 1
 
 
 def straight(ranks):
@@ -95,9 +121,402 @@ def two_pair(ranks):
     return None
 
 
+def rank_key(rank):
+    """Возвращает для ранга (результата hand_rank) класс и 5 рангов для сравнения по старшинству
+    (недостающие равны 0). Кортежи (класс, ранги) упорядочены так же, как ранги hand_rank"""
+    category = rank[0]
+    if category in (8, 4):
+        keys = [rank[1]]
+    elif category in (7, 6):
+        keys = [rank[1], rank[2]]
+    elif category in (5, 0):
+        keys = list(rank[1])
+    else:
+        pairs = list(rank[1]) if category == 2 else [rank[1]]
+        keys = pairs + [r for r in rank[2] if r not in pairs]
+    return category, tuple(keys + [0] * (5 - len(keys)))
+
+
+def pack_strength(category, keys):
+    """Возвращает целое число из класса и до 5 рангов для сравнения (как в rank_key) по 4 бита"""
+    a, b, c, d, e = (list(keys) + [0] * 4)[:5]
+    return category << 20 | a << 16 | b << 12 | c << 8 | d << 4 | e
+
+
+def pack_rank(rank):
+    """Возвращает ранг (результат hand_rank) в виде целого числа pack_strength(*rank_key(rank)).
+    Числа упорядочены так же, как ранги hand_rank"""
+    return pack_strength(*rank_key(rank))
+
+
+@lru_cache(maxsize=None)
+def unpack_rank(strength):
+    """Возвращает ранг в виде результата hand_rank по целому числу pack_rank.
+    Возвращаемое значение кэшируется и не должно изменяться"""
+    category = strength >> 20
+    keys = [strength >> shift & 0xF for shift in (16, 12, 8, 4, 0)]
+    if category in (8, 4):
+        return (category, keys[0])
+    if category in (7, 6):
+        return (category, keys[0], keys[1])
+    if category in (5, 0):
+        return (category, keys)
+    if category == 3:
+        return (3, keys[0], sorted(keys[:1] * 3 + keys[1:3], reverse=True))
+    if category == 2:
+        return (2, (keys[0], keys[1]), sorted(keys[:2] * 2 + keys[2:3], reverse=True))
+    return (1, keys[0], sorted(keys[:1] * 2 + keys[1:4], reverse=True))
+
+
+def card_mask(cards):
+    """Возвращает битовую маску карт (см. CARD_BITS)"""
+    return reduce(lambda mask, card: mask | CARD_BITS[card], cards, 0)
+
+
+def cards_disjoint(hands, mask=0):
+    """Проверяет, что в "руках" hands нет повторяющихся карт и карт из битовой маски mask"""
+    for hand in hands:
+        hand_mask = card_mask(hand)
+        if mask & hand_mask or hand_mask.bit_count() != len(hand):
+            return False
+        mask |= hand_mask
+    return True
+
+
+# Таблицы рангов записываются в файл заранее (python poker.py --build-tables) или при первом использовании
+# и затем отображаются в память (см. get_tables)
+TABLES_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'poker_tables.bin')
+TABLES_MAGIC = b'PKRTBL1\n'
+# Заголовок: сигнатура, 0x01020304 в порядке байт записавшей платформы и размеры массивов таблиц
+TABLES_HEADER = struct.Struct('=8sI4I12x')
+# Ключи рангов: суммы ключей 5 рангов (не более 4 одинаковых) различны, поэтому индексируют таблицу
+RANK_KEYS = dict(zip(RANKS, (0, 1, 5, 22, 94, 312, 992, 2422, 5624, 12522, 19998, 43258, 79415)))
+CARD_KEYS = {card: RANK_KEYS[card[0]] for card in DECK}
+# Простые числа рангов: произведение простых чисел карт однозначно определяет набор рангов руки
+RANK_PRIMES = dict(zip(RANKS, (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)))
+CARD_PRIMES = {card: RANK_PRIMES[card[0]] for card in DECK}
+# Бит ранга карты в маске рангов масти (бит 0 - двойка)
+CARD_RANK_BITS = {card: 1 << RANKS.index(card[0]) for card in DECK}
+# Счетчики мастей по 4 бита: сумма для "руки" из 7 карт содержит 5 и более в полубайте флеша
+CARD_SUIT_COUNTS = {card: 1 << 4 * SUITS.index(card[1]) for card in DECK}
+
+RankTables = namedtuple('RankTables', 'keys7 flush5 rank5 flush7 values7')
+_tables = None
+# Ранги в виде результатов hand_rank, индексированные как flush5 и rank5 (см. get_rank_tuples)
+_rank_tuples = None
+
+
+def make_tables():
+    """Строит таблицы рангов (чисел pack_rank) в памяти, возвращает RankTables массивов array:
+    flush5 и flush7 - ранги флешей из 5 карт и лучших "рук" из 5-7 карт одной масти по маске рангов,
+    rank5 - ранги "рук" из 5 карт без флеша по сумме ключей рангов карт,
+    keys7 и values7 - упорядоченные произведения простых чисел рангов 7 карт и ранги лучших "рук" без флеша"""
+    flush5 = array.array('I', bytes(4 << len(RANKS)))
+    flush7 = array.array('I', bytes(4 << len(RANKS)))
+    for mask in range(1 << len(RANKS)):
+        if mask.bit_count() >= 5:
+            cards = [RANKS[r] + SUITS[0] for r in range(len(RANKS)) if mask >> r & 1]
+            flush7[mask] = histogram_strength(cards)
+            if len(cards) == 5:
+                flush5[mask] = pack_rank(hand_rank(cards))
+    rank5 = array.array('I', bytes(4 * (4 * max(RANK_KEYS.values()) + sorted(RANK_KEYS.values())[-2] + 1)))
+    ranks7 = {}
+    for n in (5, 7):
+        for ranks in itertools.combinations_with_replacement(RANKS, n):
+            if any(ranks.count(r) > 4 for r in ranks):
+                continue
+            # одинаковые ранги идут подряд, поэтому получают разные масти, а масти не повторяются более 2 раз
+            cards = [r + SUITS[i % 4] for i, r in enumerate(ranks)]
+            if n == 5:
+                key = sum(CARD_KEYS[card] for card in cards)
+                assert not rank5[key], 'rank keys should have different sums'
+                rank5[key] = pack_rank(hand_rank(cards))
+            else:
+                ranks7[reduce(lambda x, y: x * y, map(CARD_PRIMES.get, cards))] = histogram_strength(cards)
+    keys7 = array.array('Q', sorted(ranks7))
+    values7 = array.array('I', (ranks7[key] for key in keys7))
+    return RankTables(keys7, flush5, rank5, flush7, values7)
+
+
+def build_tables(filename=TABLES_FILENAME):
+    """Строит таблицы рангов и атомарно записывает их в файл filename.
+    Временный файл уникален, поэтому процессы могут строить таблицы одновременно"""
+    tables = make_tables()
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(TABLES_HEADER.pack(TABLES_MAGIC, 0x01020304, *map(len, tables[:4])))
+            for table in tables:
+                table.tofile(f)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def load_tables(filename=TABLES_FILENAME):
+    """Отображает файл таблиц рангов в память и возвращает RankTables представлений memoryview без копирования.
+    Страницы файла разделяются процессами. Raises ValueError, если файл записан другой версией или платформой"""
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    if len(view) < TABLES_HEADER.size:
+        raise ValueError('Wrong rank tables file ' + filename)
+    magic, order, *sizes = TABLES_HEADER.unpack_from(view)
+    sizes.append(sizes[0])
+    if magic != TABLES_MAGIC or order != 0x01020304 or \
+            len(view) != TABLES_HEADER.size + 8 * sizes[0] + 4 * sum(sizes[1:]):
+        raise ValueError('Wrong rank tables file ' + filename)
+    tables = []
+    offset = TABLES_HEADER.size
+    for size, fmt in zip(sizes, 'QIIII'):
+        end = offset + size * struct.calcsize(fmt)
+        tables.append(view[offset:end].cast(fmt))
+        offset = end
+    return RankTables(*tables)
+
+
+def get_tables():
+    """Возвращает таблицы рангов, при первом вызове загружает их из файла TABLES_FILENAME.
+    Если файла нет (или он записан другой версией), таблицы строятся и записываются в него,
+    а если записать или прочитать записанный файл нельзя - используются таблицы в памяти"""
+    global _tables
+    if _tables is None:
+        try:
+            try:
+                _tables = load_tables(TABLES_FILENAME)
+            except (OSError, ValueError):
+                build_tables(TABLES_FILENAME)
+                _tables = load_tables(TABLES_FILENAME)
+        except (OSError, ValueError):
+            _tables = make_tables()
+    return _tables
+
+
+def get_rank_tuples():
+    """Возвращает пару списков рангов в виде результатов hand_rank с индексами таблиц flush5 и rank5.
+    Списки строятся в памяти при первом вызове, одинаковые ранги в них - один и тот же объект"""
+    global _rank_tuples
+    if _rank_tuples is None:
+        tables = get_tables()
+        _rank_tuples = tuple([unpack_rank(strength) if strength else None for strength in table]
+                             for table in (tables.flush5, tables.rank5))
+    return _rank_tuples
+
+
+def hand_strength(hand):
+    """Возвращает ранг "руки" из 5 карт в виде числа pack_rank по таблицам рангов"""
+    tables = _tables or get_tables()
+    a, b, c, d, e = hand
+    if a[1] == b[1] == c[1] == d[1] == e[1]:
+        bits = CARD_RANK_BITS
+        return tables.flush5[bits[a] | bits[b] | bits[c] | bits[d] | bits[e]]
+    keys = CARD_KEYS
+    return tables.rank5[keys[a] + keys[b] + keys[c] + keys[d] + keys[e]]
+
+
+def seven_strength(hand):
+    """Возвращает ранг (число pack_rank) лучшей "руки" в 5 карт для "руки" из 7 карт без джокеров по таблицам рангов"""
+    tables = _tables or get_tables()
+    key = 1
+    suits = 0
+    for card in hand:
+        key *= CARD_PRIMES[card]
+        suits += CARD_SUIT_COUNTS[card]
+    if (suits + 0x3333) & 0x8888:
+        # в 7 картах флеш исключает каре и фулл-хаус, поэтому лучшая "рука" - флеш или стрит-флеш
+        suit = SUITS[((suits + 0x3333) & 0x8888).bit_length() // 4 - 1]
+        return tables.flush7[sum(CARD_RANK_BITS[card] for card in hand if card[1] == suit)]
+    return tables.values7[bisect.bisect_left(tables.keys7, key)]
+
+
+def fast_hand_rank(hand, keys=CARD_KEYS, bits=CARD_RANK_BITS):
+    """То же, что hand_rank, для руки из 5 карт, но по таблицам рангов.
+    Возвращаемое значение разделяется с таблицей и не должно изменяться"""
+    rank_tuples = _rank_tuples or get_rank_tuples()
+    a, b, c, d, e = hand
+    if a[1] == b[1] == c[1] == d[1] == e[1]:
+        return rank_tuples[0][bits[a] | bits[b] | bits[c] | bits[d] | bits[e]]
+    return rank_tuples[1][keys[a] + keys[b] + keys[c] + keys[d] + keys[e]]
+
+
+def mask_ranks(mask, n=5):
+    """Возвращает до n старших рангов битовой маски рангов (бит r - ранг r), от большего к меньшему"""
+    return [r for r in range(14, 1, -1) if mask >> r & 1][:n]
+
+
+def straight_top(mask, wild=0):
+    """Возвращает старший ранг лучшего стрита в битовой маске рангов или None.
+    wild - число джокеров, которыми можно заменить недостающие ранги"""
+    for top in range(14, 5, -1):
+        window = 0x1F << (top - 4)
+        if (window & ~mask).bit_count() <= wild:
+            return top
+    return None
+
+
+# карты, которые могут заменить джокеры, по убыванию (см. choose_hand)
+BLACK_CARDS = tuple(sorted((rank + suit for suit in 'CS' for rank in RANKS), reverse=True))
+RED_CARDS = tuple(sorted((rank + suit for suit in 'HD' for rank in RANKS), reverse=True))
+
+
+def wild_strength(counts, suit_masks, black, red):
+    """Возвращает ранг (число pack_rank) лучшей "руки" в 5 карт по гистограмме рангов counts и маскам рангов
+    мастей suit_masks карт без джокеров и числу черных (black) и красных (red) джокеров. Джокер заменяет любую карту
+    своего цвета (в том числе уже имеющуюся в "руке"), поэтому ранги находятся без перебора замен,
+    как в best_wild_hand_brute"""
+    jokers = black + red
+    suit_jokers = {'C': black, 'S': black, 'H': red, 'D': red}
+    mask = sum(1 << r for r, n in enumerate(counts) if n)
+    tops = [straight_top(suit_masks[suit], suit_jokers[suit]) or 0 for suit in SUITS]
+    if max(tops):
+        return pack_strength(8, [max(tops)])
+    for q in range(14, 1, -1):
+        if counts[q] + jokers >= 4:
+            left = jokers - max(4 - counts[q], 0)
+            kickers = mask_ranks(mask & ~(1 << q), 1) + [14 if q != 14 else 13] * bool(left)
+            return pack_strength(7, [q, max(kickers)])
+    for t in range(14, 1, -1):
+        for p in range(14, 1, -1):
+            if p != t and max(3 - counts[t], 0) + max(2 - counts[p], 0) <= jokers:
+                return pack_strength(6, [t, p])
+    flushes = [sorted(mask_ranks(suit_masks[suit], 7) + [14] * suit_jokers[suit], reverse=True)
+               for suit in SUITS if suit_masks[suit].bit_count() + suit_jokers[suit] >= 5]
+    if flushes:
+        return pack_strength(5, max(flushes))
+    if straight_top(mask, jokers):
+        return pack_strength(4, [straight_top(mask, jokers)])
+    for t in range(14, 1, -1):
+        if counts[t] + jokers >= 3:
+            left = jokers - max(3 - counts[t], 0)
+            kickers = sorted(mask_ranks(mask & ~(1 << t), 2) + [14 if t != 14 else 13] * left, reverse=True)
+            return pack_strength(3, [t] + kickers)
+    # с джокером без троек, стритов и флешей остается пара к старшей карте
+    return pack_strength(1, mask_ranks(mask, 4))
+
+
+def histogram_strength(hand):
+    """Из "руки" в 5-7 карт за один проход возвращает ранг (число pack_rank) лучшей "руки" в 5 карт.
+    Использует гистограмму рангов, маски рангов по мастям и маски стритов.
+    "Рука" может включать джокеров '?B' и '?R' (см. best_wild_hand)"""
+    counts = [0] * 15
+    suit_masks = dict.fromkeys(SUITS, 0)
+    black = red = 0
+    for card in hand:
+        if card[0] == '?':
+            black += card == '?B'
+            red += card == '?R'
+            continue
+        rank = RANK_VALUES[card[0]]
+        counts[rank] += 1
+        suit_masks[card[1]] |= 1 << rank
+    if black or red:
+        return wild_strength(counts, suit_masks, black, red)
+    flush_mask = next((mask for mask in suit_masks.values() if mask.bit_count() >= 5), 0)
+    if flush_mask and straight_top(flush_mask):
+        return pack_strength(8, [straight_top(flush_mask)])
+    # группы (количество, ранг) от большего к меньшему
+    groups = sorted(((n, r) for r, n in enumerate(counts) if n), reverse=True)
+    (n1, r1), (n2, r2) = groups[0], groups[1]
+    if n1 == 4:
+        return pack_strength(7, [r1, max(r for n, r in groups if r != r1)])
+    if n1 == 3 and n2 >= 2:
+        return pack_strength(6, [r1, r2])
+    if flush_mask:
+        return pack_strength(5, mask_ranks(flush_mask))
+    mask = sum(1 << r for n, r in groups)
+    if straight_top(mask):
+        return pack_strength(4, [straight_top(mask)])
+    if n1 == 3:
+        return pack_strength(3, [r1] + mask_ranks(mask & ~(1 << r1), 2))
+    if n1 == 2 and n2 == 2:
+        return pack_strength(2, [r1, r2] + mask_ranks(mask & ~(1 << r1 | 1 << r2), 1))
+    if n1 == 2:
+        return pack_strength(1, [r1] + mask_ranks(mask & ~(1 << r1), 3))
+    return pack_strength(0, mask_ranks(mask))
+
+
+def best_strength(hand):
+    """Из "руки" в 5-7 карт возвращает ранг (число pack_rank) лучшей "руки" в 5 карт:
+    для 7 карт без джокеров - по таблицам рангов (seven_strength), иначе - histogram_strength"""
+    if len(hand) == 7 and '?B' not in hand and '?R' not in hand:
+        return seven_strength(hand)
+    return histogram_strength(hand)
+
+
+def best_rank(hand):
+    """Из "руки" в 5-7 карт возвращает ранг (как hand_rank) лучшей "руки" в 5 карт (см. best_strength).
+    Возвращаемое значение кэшируется и не должно изменяться"""
+    return unpack_rank(best_strength(hand))
+
+
+def rank_cards(rank):
+    """Возвращает ранги 5 карт руки с рангом rank (результатом hand_rank)"""
+    if rank[0] in (8, 4):
+        return list(range(rank[1], rank[1] - 5, -1))
+    if rank[0] == 7:
+        return [rank[1]] * 4 + [rank[2]]
+    if rank[0] == 6:
+        return [rank[1]] * 3 + [rank[2]] * 2
+    return rank[-1]
+
+
+def can_choose(slots, need, suit=None):
+    """Проверяет, что из позиций slots можно выбрать карты с рангами need (список количеств по рангам)
+    и мастью suit (если задана). Позиция из нескольких карт (джокер) может дать карту любого ранга"""
+    have = [0] * 15
+    free = 0
+    for slot in slots:
+        if len(slot) == 1:
+            if suit is None or slot[0][1] == suit:
+                have[RANK_VALUES[slot[0][0]]] += 1
+        elif suit is None or any(card[1] == suit for card in slot):
+            free += 1
+    return sum(n - h for n, h in zip(need, have) if n > h) <= free
+
+
+def choose_hand(slots, rank):
+    """Из позиций "руки" slots (по порядку: кортежи карт, которые может принимать позиция, по убыванию -
+    (card,) для карты) выбирает "руку" в 5 карт с рангом rank. Как и перебор сочетаний в best_rank_and_hand,
+    из равных по рангу "рук" возвращает лексикографически наибольший кортеж карт"""
+    need = [0] * 15
+    for r in rank_cards(rank):
+        need[r] += 1
+    hands = []
+    for suit in (SUITS if rank[0] in (8, 5) else (None,)):
+        if not can_choose(slots, need, suit):
+            continue
+        fits = [slot[0] for slot in slots
+                if len(slot) == 1 and need[RANK_VALUES[slot[0][0]]] and (suit is None or slot[0][1] == suit)]
+        if len(fits) == 5 and all(len(slot) == 1 for slot in slots):
+            # подходящих карт ровно 5 и нет джокеров - выбирать не из чего
+            hands.append(tuple(fits))
+            continue
+        hand = []
+        left = list(need)
+        start = 0
+        while len(hand) < 5:
+            best = None
+            for i in range(start, len(slots)):
+                for card in slots[i]:
+                    if best is not None and card <= best[1]:
+                        break
+                    r = RANK_VALUES[card[0]]
+                    if left[r] and (suit is None or card[1] == suit):
+                        left[r] -= 1
+                        if can_choose(slots[i + 1:], left, suit):
+                            best = (i, card)
+                        left[r] += 1
+            start, card = best[0] + 1, best[1]
+            left[RANK_VALUES[card[0]]] -= 1
+            hand.append(card)
+        hands.append(tuple(hand))
+    return max(hands)
+
+
 def best_hand(hand):
     """Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт """
-    return best_rank_and_hand(hand)[1]
+    return choose_hand([(card,) for card in hand], best_rank(hand))
 
 
 def best_rank_and_hand(hand):
@@ -120,6 +539,14 @@ def best_ranks_and_hands_of_five(hand, deck1, deck2):
 
 def best_wild_hand(hand):
     """best_hand но с джокерами"""
+    # позиции как при переборе в best_wild_hand_brute: замены черного и красного джокеров, затем карты
+    slots = [BLACK_CARDS] * ('?B' in hand) + [RED_CARDS] * ('?R' in hand)
+    return choose_hand(slots + [(card,) for card in hand if card[0] != '?'], best_rank(hand))
+
+
+def best_wild_hand_brute(hand):
+    """best_wild_hand перебором всех замен джокеров (медленно, для проверки)"""
+    hand = list(hand)
     black_cards = (x + y for y in 'CS' for x in '23456789TJQKA')
     red_cards = (m + n for n in 'HD' for m in '23456789TJQKA')
     if '?R' in hand and '?B' in hand:
@@ -139,6 +566,211 @@ def best_wild_hand(hand):
         return best_hand(hand)
 
 
+def encode_cards(hands):
+    """Возвращает массив numpy (N, k) номеров карт для N "рук" из k карт в формате 'RS'"""
+    if np is None:
+        raise ImportError('numpy is required for batch hand ranking')
+    return np.array([[CARD_INDEX[card] for card in hand] for hand in hands], dtype=np.int8).reshape(len(hands), -1)
+
+
+def decode_cards(cards):
+    """Возвращает список "рук" из карт в формате 'RS' по массиву (N, k) номеров карт"""
+    return [[DECK[i] for i in row] for row in cards.tolist()]
+
+
+def pack_keys(classes, keys):
+    """Возвращает массив рангов в виде чисел pack_rank по классам и рангам для сравнения (см. rank_hands)"""
+    strengths = classes.astype(np.int32)
+    for column in keys.T:
+        strengths = strengths << 4 | column
+    return strengths
+
+
+def _top_ranks(present, n):
+    """Возвращает (N, n) старших рангов (или 0), для которых в строках present (N, 13) стоит True"""
+    values = np.where(present, np.arange(2, 15, dtype=np.int8), np.int8(0))
+    return np.sort(values, axis=1)[:, :-n - 1:-1]
+
+
+def _straight_tops(masks):
+    """Возвращает старшие ранги стритов (или 0) для масок рангов (бит i - ранг i + 2)"""
+    tops = np.zeros(len(masks), dtype=np.int8)
+    for top in range(14, 5, -1):
+        window = 0x1F << (top - 6)
+        tops[(tops == 0) & (masks & window == window)] = top
+    return tops
+
+
+def rank_hands(cards):
+    """Ранжирует N "рук" из 7 карт, заданных массивом (N, 7) номеров карт (см. encode_cards), без цикла по "рукам".
+    Возвращает массивы классов (N,) и рангов для сравнения (N, 5) лучших "рук" из 5 карт, как rank_key(best_rank)"""
+    if np is None:
+        raise ImportError('numpy is required for batch hand ranking')
+    cards = np.asarray(cards)
+    count = len(cards)
+    ranks, suits = cards // 4, cards % 4
+    rows = np.arange(count)
+    counts = np.zeros((count, 13), dtype=np.int8)
+    for column in ranks.T:
+        counts[rows, column] += 1
+    bits = np.left_shift(1, ranks.astype(np.int32))
+    rank_values = np.arange(2, 15, dtype=np.int8)
+    present = counts > 0
+    mask = present.astype(np.int32) @ (1 << np.arange(13, dtype=np.int32))
+    flush_mask = np.zeros(count, dtype=np.int32)
+    for suit in range(4):
+        in_suit = suits == suit
+        flush_mask = np.where(in_suit.sum(axis=1) >= 5, (bits * in_suit).sum(axis=1), flush_mask)
+    flush_tops = _straight_tops(flush_mask)
+    straight_tops = _straight_tops(mask)
+
+    def highest(condition):
+        return np.where(condition, rank_values, np.int8(0)).max(axis=1)
+
+    def without(*excluded):
+        return present & ~np.any([rank_values == r[:, None] for r in excluded], axis=0)
+
+    quads, trips = highest(counts == 4), highest(counts == 3)
+    pairs = _top_ranks(counts == 2, 2)
+    full_pairs = highest((counts >= 2) & (rank_values != trips[:, None]))
+    # классы в порядке возрастания: старший подходящий класс записывается последним
+    categories = [
+        (0, None, _top_ranks(present, 5)),
+        (1, pairs[:, 0] > 0, np.column_stack([pairs[:, 0], _top_ranks(without(pairs[:, 0]), 3)])),
+        (2, pairs[:, 1] > 0, np.column_stack([pairs, _top_ranks(without(pairs[:, 0], pairs[:, 1]), 1)])),
+        (3, trips > 0, np.column_stack([trips, _top_ranks(without(trips), 2)])),
+        (4, straight_tops > 0, straight_tops[:, None]),
+        (5, flush_mask > 0, _top_ranks((flush_mask[:, None] >> np.arange(13)) & 1 > 0, 5)),
+        (6, (trips > 0) & (full_pairs > 0), np.column_stack([trips, full_pairs])),
+        (7, quads > 0, np.column_stack([quads, _top_ranks(without(quads), 1)])),
+        (8, flush_tops > 0, flush_tops[:, None]),
+    ]
+    classes = np.zeros(count, dtype=np.int8)
+    keys = np.zeros((count, 5), dtype=np.int8)
+    for category, condition, values in categories:
+        condition = np.ones(count, dtype=bool) if condition is None else condition
+        classes[condition] = category
+        keys[condition] = 0
+        keys[condition, :values.shape[1]] = values[condition]
+    return classes, keys
+
+
+# Наибольшее число раздач, при котором эквити считается перебором (exact=None)
+EQUITY_EXACT_LIMIT = 200000
+# Число испытаний Монте-Карло в одной задаче; у каждой задачи свой генератор, поэтому результат
+# при заданном seed не зависит от числа процессов
+EQUITY_CHUNK_SIZE = 5000
+
+EquityResult = namedtuple('EquityResult', 'equities margins deals exact')
+
+
+def deal_shares(holes, board):
+    """Возвращает доли выигрыша игроков с картами holes при общих картах board (банк делится при ничьей)"""
+    strengths = [best_strength(list(hole) + list(board)) for hole in holes]
+    best = max(strengths)
+    winners = strengths.count(best)
+    return [1 / winners if strength == best else 0.0 for strength in strengths]
+
+
+def _add_shares(totals, shares):
+    """Добавляет доли выигрыша раздачи к суммам (число раздач, суммы долей, суммы квадратов долей)"""
+    totals[0] += 1
+    for i, share in enumerate(shares):
+        totals[1][i] += share
+        totals[2][i] += share * share
+
+
+def _exact_task(task):
+    """Перебирает раздачи с картами игроков holes, в которых первая из недостающих общих карт - rest[first]"""
+    holes, board, rest, first = task
+    totals = [0, [0.0] * len(holes), [0.0] * len(holes)]
+    missing = 5 - len(board)
+    boards = [()] if not missing else \
+        ((rest[first],) + cards for cards in itertools.combinations(rest[first + 1:], missing - 1))
+    for cards in boards:
+        _add_shares(totals, deal_shares(holes, board + cards))
+    return totals
+
+
+def _sample_task(task):
+    """Разыгрывает trials случайных раздач генератором, зависящим только от seed и номера задачи chunk"""
+    ranges, board, deck, trials, seed, chunk = task
+    rnd = random.Random('{}:{}'.format(seed, chunk))
+    totals = [0, [0.0] * len(ranges), [0.0] * len(ranges)]
+    masks = [{hand: card_mask(hand) for hand in hands} for hands in ranges]
+    board_mask = card_mask(board)
+    for _ in range(trials):
+        while True:
+            holes = [rnd.choice(hands) for hands in ranges]
+            used = board_mask
+            for hole, hole_masks in zip(holes, masks):
+                if used & hole_masks[hole]:
+                    break
+                used |= hole_masks[hole]
+            else:
+                break
+        rest = [card for card in deck if not used & CARD_BITS[card]]
+        _add_shares(totals, deal_shares(holes, board + tuple(rnd.sample(rest, 5 - len(board)))))
+    return totals
+
+
+def equity(players, board=(), dead=(), exact=None, trials=100000, workers=1, seed=0, jokers=False,
+           confidence=0.95):
+    """Возвращает EquityResult: эквити (долю выигрыша с учетом ничьих) игроков players и полуширину
+    доверительного интервала с уровнем confidence (0 при переборе).
+    Игрок задается "рукой" (картами, например ['AS', 'AH']) или диапазоном (списком "рук").
+    board - известные общие карты, dead - вышедшие из игры карты.
+    Раздачи перебираются, если exact или если exact=None и их не более EQUITY_EXACT_LIMIT,
+    иначе разыгрываются trials раздач Монте-Карло (seed задает последовательность раздач).
+    Задачи распределяются по пулу из workers процессов. При jokers=True в колоде есть джокеры '?B' и '?R',
+    которые разыгрываются как в best_wild_hand"""
+    ranges = [[tuple(player)] if isinstance(player[0], str) else [tuple(hand) for hand in player]
+              for player in players]
+    board = tuple(board)
+    deck = [card for card in DECK + JOKERS * jokers if card not in set(board) | set(dead)]
+    taken = card_mask(board) | card_mask(dead)
+    # "руки" диапазонов с общими или вышедшими картами не разыгрываются ни при переборе, ни методом Монте-Карло
+    ranges = [[hand for hand in hands if not card_mask(hand) & taken] for hands in ranges]
+    combos = [holes for holes in itertools.product(*ranges) if cards_disjoint(holes, taken)]
+    if not combos:
+        raise ValueError('No deals for players ' + repr(players))
+    missing = 5 - len(board)
+    deals = len(combos) * math.comb(len(deck) - sum(map(len, combos[0])), missing)
+    if exact is None:
+        exact = deals <= EQUITY_EXACT_LIMIT
+    if exact:
+        tasks = []
+        for holes in combos:
+            rest = [card for card in deck if card not in set().union(*holes)]
+            # задача на каждую первую из недостающих общих карт
+            firsts = range(len(rest) - missing + 1) if missing else [0]
+            tasks.extend((holes, board, rest, first) for first in firsts)
+        func = _exact_task
+    else:
+        tasks = [(ranges, board, deck, min(EQUITY_CHUNK_SIZE, trials - start), seed, chunk)
+                 for chunk, start in enumerate(range(0, trials, EQUITY_CHUNK_SIZE))]
+        func = _sample_task
+    if workers > 1:
+        # таблицы загружаются до создания пула, чтобы процессы пула (при fork) получили готовое отображение
+        get_tables()
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(func, tasks)
+    else:
+        results = map(func, tasks)
+    count, sums, squares = 0, [0.0] * len(ranges), [0.0] * len(ranges)
+    for task_count, task_sums, task_squares in results:
+        count += task_count
+        sums = [x + y for x, y in zip(sums, task_sums)]
+        squares = [x + y for x, y in zip(squares, task_squares)]
+    equities = [x / count for x in sums]
+    if exact:
+        margins = [0.0] * len(equities)
+    else:
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        margins = [z * math.sqrt(max(sq / count - eq * eq, 0.0) / count) for eq, sq in zip(equities, squares)]
+    return EquityResult(equities, margins, count, exact)
+
+
 def test_best_hand():
     print("test_best_hand...")
     assert (sorted(best_hand("6C 7C 8C 9C TC 5C JS".split()))
@@ -150,6 +782,104 @@ def test_best_hand():
     print('OK')
 
 
+def test_fast_hand_rank():
+    print("test_fast_hand_rank...")
+    for hand in itertools.combinations(DECK, 5):
+        assert fast_hand_rank(hand) == hand_rank(hand), hand
+    print('OK')
+
+
+def test_tables():
+    print("test_tables...")
+    with tempfile.TemporaryDirectory() as tables_dir:
+        filename = os.path.join(tables_dir, 'poker_tables.bin')
+        build_tables(filename)
+        assert os.listdir(tables_dir) == ['poker_tables.bin']
+        tables = load_tables(filename)
+        assert all(a.tolist() == b.tolist() for a, b in zip(make_tables(), tables))
+        rnd = random.Random(0)
+        for _ in range(20000):
+            hand = rnd.sample(DECK, 7)
+            assert seven_strength(hand) == histogram_strength(hand), hand
+            assert hand_strength(hand[:5]) == pack_rank(hand_rank(hand[:5])), hand
+        with open(filename, 'r+b') as f:
+            f.write(b'WRONG')
+        try:
+            load_tables(filename)
+            assert False, 'ValueError expected'
+        except ValueError:
+            pass
+    print('OK')
+
+
+def test_pack_rank():
+    print("test_pack_rank...")
+    tables = get_tables()
+    strengths = sorted((set(tables.flush5) | set(tables.rank5)) - {0})
+    ranks = [unpack_rank(strength) for strength in strengths]
+    assert len(strengths) == 7462 and sorted(ranks) == ranks
+    assert [pack_rank(rank) for rank in ranks] == strengths
+    assert card_mask(['2C', 'AS', '?R']) == 1 | 1 << 51 | 1 << 53
+    print('OK')
+
+
+def test_wild_rank():
+    print("test_wild_rank...")
+    rnd = random.Random(0)
+    for i in range(240):
+        # часть "рук" из младших рангов или двух мастей, чтобы чаще встречались пары, стриты и флеши
+        deck = (DECK, DECK[:20], DECK[::2])[i % 3]
+        cards = rnd.sample(deck, 5 + i % 2) + rnd.sample(['?B', '?R'], 2 - i % 2)
+        rnd.shuffle(cards)
+        assert best_wild_hand(cards) == best_wild_hand_brute(cards), cards
+        assert best_rank(cards) == hand_rank(best_wild_hand(cards)), cards
+    print('OK')
+
+
+def test_best_rank():
+    print("test_best_rank...")
+    rnd = random.Random(0)
+    for _ in range(20000):
+        hand = rnd.sample(DECK, 7)
+        assert (best_rank(hand), best_hand(hand)) == best_rank_and_hand(hand), hand
+    print('OK')
+
+
+def test_rank_hands():
+    print("test_rank_hands...")
+    if np is None:
+        print('numpy is not installed, skipped')
+        return
+    rnd = random.Random(0)
+    hands = [rnd.sample(DECK[:28] if i % 2 else DECK, 7) for i in range(20000)]
+    cards = encode_cards(hands)
+    assert decode_cards(cards) == hands
+    classes, keys = rank_hands(cards)
+    for hand, category, key, strength in zip(hands, classes.tolist(), keys.tolist(), pack_keys(classes, keys).tolist()):
+        assert (category, tuple(key)) == rank_key(best_rank(hand)) and strength == best_strength(hand), hand
+    print('OK')
+
+
+def test_equity():
+    print("test_equity...")
+    assert equity([['AS', 'AH'], ['KS', 'KH']], '2C 7D 9H JS 3D'.split()).equities == [1.0, 0.0]
+    assert equity([['2S', '3H'], ['4S', '5H']], 'TC JC QC KC AC'.split()).equities == [0.5, 0.5]
+    flop = '2C 7D 9H'.split()
+    exact = equity([['AS', 'AH'], [['KS', 'KH'], ['QS', 'QH']]], flop)
+    assert exact.exact and exact.deals == 2 * 990 and abs(sum(exact.equities) - 1) < 1e-9
+    sampled = equity([['AS', 'AH'], [['KS', 'KH'], ['QS', 'QH']]], flop, exact=False, trials=6000, seed=1)
+    assert abs(sampled.equities[0] - exact.equities[0]) < 4 * sampled.margins[0] + 1e-9
+    assert sampled == equity([['AS', 'AH'], [['KS', 'KH'], ['QS', 'QH']]], flop, exact=False, trials=6000, seed=1,
+                             workers=2)
+    exact = equity([['AS', 'AH'], [['KS', 'KH'], ['QS', 'QH']]], flop, dead=['KS'])
+    assert exact == equity([['AS', 'AH'], ['QS', 'QH']], flop, dead=['KS'])
+    sampled = equity([['AS', 'AH'], [['KS', 'KH'], ['QS', 'QH']]], flop, dead=['KS'], exact=False, trials=6000)
+    assert sampled == equity([['AS', 'AH'], ['QS', 'QH']], flop, dead=['KS'], exact=False, trials=6000)
+    wild = equity([['?B', '2D'], ['KS', 'KH']], 'AC AD 7H 3S'.split(), jokers=True)
+    assert wild.deals == 46 and wild.equities == [44 / 46, 2 / 46]
+    print('OK')
+
+
 # noinspection PyPep8,PyPep8,PyPep8
 def test_best_wild_hand():
     print("test_best_wild_hand...")
@@ -164,5 +894,19 @@ def test_best_wild_hand():
 
 
 if __name__ == '__main__':
-    test_best_hand()
-    test_best_wild_hand()
+    if sys.argv[1:] == ['--build-tables']:
+        build_tables(TABLES_FILENAME)
+        print('Rank tables are written to ' + TABLES_FILENAME)
+        sys.exit()
+    # тесты используют свой файл таблиц, чтобы не записывать его рядом с модулем
+    with tempfile.TemporaryDirectory() as tables_dir:
+        TABLES_FILENAME = os.path.join(tables_dir, 'poker_tables.bin')
+        test_best_hand()
+        test_best_wild_hand()
+        test_best_rank()
+        test_wild_rank()
+        test_rank_hands()
+        test_equity()
+        test_tables()
+        test_pack_rank()
+        test_fast_hand_rank()